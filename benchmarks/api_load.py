@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# pyBMC API load and latency benchmark
+#
+# Starts pyBMC under hypercorn against the simulated hardware backend and
+# drives it with simulated dashboards at the browser's cadence (system state
+# every 250ms, BMC stats every second), over HTTP and/or the websocket.
+# Results are written as JSON so runs can be compared between releases.
+#
+# Usage: python benchmarks/api_load.py --http-clients 10 --ws-clients 10 --duration 30
+#
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT_DIR, "pyBMC")
+
+STATE_INTERVAL = 0.25
+STATS_INTERVAL = 1.0
+LAG_PROBE_INTERVAL = 0.01
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def summarize(samples, duration):
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "throughput": len(values) / duration,
+        "p50Ms": percentile(values, 50),
+        "p99Ms": percentile(values, 99),
+        "p999Ms": percentile(values, 99.9),
+        "maxMs": values[-1] if values else None,
+    }
+
+#
+# Server side (runs in a child process so clients don't share its event loop)
+#
+
+def run_server(host, port, done, results):
+    os.environ["PYBMC_BACKEND"] = "simulated"
+    # Keep the simulated readings out of the real history file
+    history_dir = tempfile.TemporaryDirectory()
+    os.environ["PYBMC_HISTORY_FILE"] = os.path.join(history_dir.name, "pybmc.history")
+    # pyBMC looks for its configuration (and writes its log) in the current directory
+    os.chdir(APP_DIR)
+    sys.path.insert(0, ROOT_DIR)
+
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    from pyBMC import create_app
+
+    lags = []
+
+    async def probe_lag():
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            lags.append((loop.time() - expected) * 1000)
+
+    async def main():
+        config = Config()
+        config.bind = [f"{host}:{port}"]
+        config.accesslog = None
+        config.errorlog = None
+
+        shutdown = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, lambda: (done.wait(), loop.call_soon_threadsafe(shutdown.set)))
+
+        app = create_app()
+
+        @app.before_serving
+        async def start_lag_probe():
+            app.lag_probe = asyncio.create_task(probe_lag())
+
+        await serve(app, config, shutdown_trigger=shutdown.wait)
+        app.lag_probe.cancel()
+
+    asyncio.run(main())
+    history_dir.cleanup()
+    results.put(lags)
+
+#
+# Client side
+#
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, started, ok=True):
+        if ok:
+            self.latencies.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        else:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+async def every(interval, deadline, func):
+    loop = asyncio.get_running_loop()
+    next_run = loop.time()
+    while next_run < deadline:
+        await func()
+        next_run += interval
+        await asyncio.sleep(max(0, next_run - loop.time()))
+
+async def http_client(session, base_uri, deadline, recorder):
+    async def get(name, path):
+        started = time.perf_counter()
+        try:
+            async with session.get(base_uri + path) as response:
+                await response.read()
+                recorder.record(name, started, response.status == 200)
+        except aiohttp.ClientError:
+            recorder.record(name, started, False)
+
+    await asyncio.gather(
+        every(STATE_INTERVAL, deadline, lambda: get("http /api/v1/state", "/api/v1/state")),
+        every(STATS_INTERVAL, deadline, lambda: get("http /api/v1/bmc/stats", "/api/v1/bmc/stats")))
+
+async def ws_client(session, base_uri, deadline, recorder):
+    async with session.ws_connect(base_uri + "/api/v1/ws") as ws:
+        # Requests are answered concurrently, so match responses by request id
+        pending = {}
+        next_id = 0
+
+        async def receive():
+            async for message in ws:
+                data = json.loads(message.data)
+                started = pending.pop(data["id"])
+                recorder.record(f"ws {data['request']}", started, "message" not in (data["response"] or {}))
+
+        async def send(command):
+            nonlocal next_id
+            if ws.closed:
+                recorder.record(f"ws {command}", 0, False)
+                return
+            next_id += 1
+            pending[next_id] = time.perf_counter()
+            await ws.send_str(json.dumps({ "command": command, "id": next_id }))
+
+        receiver = asyncio.create_task(receive())
+        await asyncio.gather(
+            every(STATE_INTERVAL, deadline, lambda: send("getSystemState")),
+            every(STATS_INTERVAL, deadline, lambda: send("getBmcStats")))
+        # Give in-flight requests a moment to come back
+        await asyncio.sleep(0.5)
+        receiver.cancel()
+
+async def wait_for_server(session, base_uri, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(base_uri + "/api/v1/state") as response:
+                await response.read()
+                return
+        except aiohttp.ClientConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+async def run_clients(args, base_uri):
+    recorder = Recorder()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await wait_for_server(session, base_uri, 30)
+
+        # The simulated fans only spin while the PSU is on
+        async with session.post(base_uri + "/api/v1/psu/power", json={ "powerState": "on" }) as response:
+            await response.read()
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + args.duration
+        clients = []
+        for _ in range(args.http_clients):
+            clients.append(http_client(session, base_uri, deadline, recorder))
+        for _ in range(args.ws_clients):
+            clients.append(ws_client(session, base_uri, deadline, recorder))
+        await asyncio.gather(*clients)
+        elapsed = loop.time() - started
+
+    return recorder, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="pyBMC API load and latency benchmark")
+    parser.add_argument("--http-clients", type=int, default=10, help="number of HTTP polling clients")
+    parser.add_argument("--ws-clients", type=int, default=10, help="number of websocket clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    done = ctx.Event()
+    results = ctx.Queue()
+    server = ctx.Process(target=run_server, args=(args.host, args.port, done, results))
+    server.start()
+
+    try:
+        base_uri = f"http://{args.host}:{args.port}"
+        recorder, elapsed = asyncio.run(run_clients(args, base_uri))
+    finally:
+        done.set()
+    lags = results.get(timeout=30)
+    server.join()
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {
+            "httpClients": args.http_clients,
+            "wsClients": args.ws_clients,
+            "duration": args.duration,
+        },
+        "endpoints": {},
+        "eventLoopLag": summarize(lags, elapsed),
+    }
+    for name in sorted(set(recorder.latencies) | set(recorder.errors)):
+        result = summarize(recorder.latencies.get(name, []), elapsed)
+        result["errors"] = recorder.errors.get(name, 0)
+        report["endpoints"][name] = result
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,37 @@
 
 # Copied from https://github.com/joan2937/pigpio/blob/master/EXAMPLES/Python/DHT22_AM2302_SENSOR/DHT22.py
 
+import asyncio
 import time
+from collections import namedtuple
 import pigpio
 
 INVALID_VALUE = -999
 POLL_INTERVAL = 3
 
+# Readings closer together than this will eventually hang the sensor
+MIN_INTERVAL = 2
+
+# Start pulse length and the time we give the sensor to finish a frame
+START_PULSE_MS = 17
+ACQUIRE_TIMEOUT = 0.5
+
+Reading = namedtuple("Reading", ["temperature", "humidity"])
+
+
+class DHT22Error(RuntimeError):
+    """Base class for errors raised by an acquisition."""
+
+class ChecksumError(DHT22Error):
+    """The message was received but its checksum didn't match."""
+
+class ShortMessageError(DHT22Error):
+    """The sensor stopped sending before all 40 bits were received."""
+
+class ReadTimeoutError(DHT22Error):
+    """The sensor didn't answer the start pulse."""
+
+
 class sensor:
     """
     A class to read relative humidity and temperature from the
@@ -83,6 +108,19 @@ class sensor:
 
         self.reading = False
 
+        # Acquisition in progress, if any, and the loop its future belongs to
+        self._future = None
+        self._loop = None
+
+        # The start pulse is generated by a script running inside pigpiod, so
+        # neither the caller nor the event loop has to sleep through it.
+        self._script = None
+        try:
+            self._script = pi.store_script(
+                f"w {gpio} 0 mils {START_PULSE_MS} m {gpio} r".encode())
+        except pigpio.error:
+            pass
+
         pi.set_pull_up_down(gpio, pigpio.PUD_OFF)
 
         pi.set_watchdog(gpio, 0)  # Kill any watchdogs.
@@ -140,9 +178,12 @@ class sensor:
                         if self.LED is not None:
                             self.pi.write(self.LED, 0)
 
+                        self._resolve(Reading(self.temp, self.rhum))
+
                     else:
 
                         self.bad_CS += 1
+                        self._reject(ChecksumError("bad checksum"))
 
                     self.reading = False
 
@@ -178,6 +219,7 @@ class sensor:
             self.reading = False
             if self.bit < 8:  # Too few data bits received.
                 self.bad_MM += 1  # Bump missing message count.
+                self._reject(ReadTimeoutError("no response from sensor"))
                 self.no_response += 1
                 if self.no_response > self.MAX_NO_RESPONSE:
                     self.no_response = 0
@@ -191,6 +233,7 @@ class sensor:
                         self.powered = True
             elif self.bit < 39:  # Short message receieved.
                 self.bad_SM += 1  # Bump short message count.
+                self._reject(ShortMessageError(f"only {self.bit} bits received"))
                 self.no_response = 0
 
             else:  # Full message received.
@@ -239,6 +282,75 @@ class sensor:
             self.pi.set_watchdog(self.gpio, 200)
             self.reading = True
 
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        """
+        Start a new reading and return an asyncio future for it.
+
+        The future is completed from the edge callback with a Reading, or
+        fails with ChecksumError, ShortMessageError or ReadTimeoutError.
+        Callers asking while a reading is in flight share its future.
+        Must be called from the event loop.
+        """
+        if self._future is not None and not self._future.done():
+            return self._future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.powered:
+            future.set_exception(ReadTimeoutError("sensor is being power cycled"))
+            return future
+
+        self._loop = loop
+        self._future = future
+
+        # Safety net in case the watchdog never fires
+        handle = loop.call_later(timeout, self._settle, future, None,
+            ReadTimeoutError(f"no reading after {timeout}s"))
+        future.add_done_callback(lambda _: handle.cancel())
+
+        if self.LED is not None:
+            self.pi.write(self.LED, 1)
+
+        if self._script is not None:
+            try:
+                self.pi.run_script(self._script)
+                self._arm()
+                return future
+            except pigpio.error:
+                # Script not ready (or gone); fall back to timing it ourselves
+                pass
+
+        self.pi.write(self.gpio, pigpio.LOW)
+        loop.call_later(START_PULSE_MS / 1000, self._release)
+        return future
+
+    def _release(self):
+        self.pi.set_mode(self.gpio, pigpio.INPUT)
+        self._arm()
+
+    def _arm(self):
+        self.pi.set_watchdog(self.gpio, 200)
+        self.reading = True
+
+    def _resolve(self, value):
+        future = self._future
+        if future is not None and not future.done():
+            self._loop.call_soon_threadsafe(self._settle, future, value, None)
+
+    def _reject(self, error):
+        future = self._future
+        if future is not None and not future.done():
+            self._loop.call_soon_threadsafe(self._settle, future, None, error)
+
+    @staticmethod
+    def _settle(future, value, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
     def update_state(self):
         #if self.tov is None or time.time() >= self.tov + POLL_INTERVAL:
         staleness = self.staleness()
@@ -262,6 +374,10 @@ class sensor:
             self.cb.cancel()
             self.cb = None
 
+        if self._script is not None:
+            self.pi.delete_script(self._script)
+            self._script = None
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,176 @@
+#
+# Windowed aggregates over the sensor history, computed with NumPy
+#
+
+import re
+import numpy
+
+# Most buckets a single query may ask for
+MAX_BUCKETS = 10000
+
+# Metrics the history can be grouped by, and the names of their groups
+GROUPS = {
+    "psu.powerState": ("off", "on"),
+    "psu.powerOk": ("off", "on"),
+}
+
+STATISTICS = ("min", "max", "mean", "count", "timeAbove")
+PERCENTILE = re.compile(r"p(\d{1,2}(\.\d+)?)$")
+
+class AggregateError(RuntimeError):
+    pass
+
+
+def parse_statistics(names):
+    for name in names:
+        if name not in STATISTICS and not PERCENTILE.match(name):
+            raise AggregateError(f"Unknown statistic '{name}'")
+    return names
+
+def load_series(tier, metric, start_time, end_time):
+    """Return the tier's timestamps and min/avg/max columns as NumPy arrays."""
+    runs = tier.slices(metric, start_time, end_time)
+    timestamps = numpy.concatenate([numpy.frombuffer(t, dtype=numpy.float64) for t, _ in runs] or
+        [numpy.empty(0)])
+    columns = {}
+    for field in ("min", "avg", "max"):
+        columns[field] = numpy.concatenate([numpy.frombuffer(c[field], dtype=numpy.float32) for _, c in runs] or
+            [numpy.empty(0, dtype=numpy.float32)]).astype(numpy.float64)
+    return timestamps, columns
+
+def reduce_buckets(ufunc, values, bucket_index, bucket_count, empty=numpy.nan):
+    """
+    Apply ufunc.reduceat to each bucket's values (bucket_index must be sorted)
+    and return one result per bucket, `empty` for buckets with no values.
+    """
+    result = numpy.full(bucket_count, empty, dtype=numpy.float64)
+    if len(values) == 0:
+        return result
+    starts = numpy.flatnonzero(numpy.diff(bucket_index, prepend=-1))
+    result[bucket_index[starts]] = ufunc.reduceat(values, starts)
+    return result
+
+def bucket_percentile(values, bucket_index, bucket_count, q):
+    """Linearly interpolated q-th percentile of each bucket's (non NaN) values."""
+    result = numpy.full(bucket_count, numpy.nan)
+    valid = ~numpy.isnan(values)
+    values = values[valid]
+    bucket_index = bucket_index[valid]
+    if len(values) == 0:
+        return result
+
+    # Sort by bucket, then by value within each bucket
+    order = numpy.lexsort((values, bucket_index))
+    values = values[order]
+    bucket_index = bucket_index[order]
+
+    starts = numpy.flatnonzero(numpy.diff(bucket_index, prepend=-1))
+    counts = numpy.diff(numpy.append(starts, len(values)))
+    position = starts + (q / 100) * (counts - 1)
+    low = numpy.floor(position).astype(numpy.int64)
+    high = numpy.minimum(low + 1, starts + counts - 1)
+    fraction = position - low
+    result[bucket_index[starts]] = values[low] + (values[high] - values[low]) * fraction
+    return result
+
+def time_above(columns, threshold, step, raw):
+    """Seconds each point spent above the threshold."""
+    if raw:
+        return (columns["avg"] > threshold).astype(numpy.float64) * step
+
+    # A rollup only tells its range, so assume its values were spread evenly over it
+    minimum, maximum = columns["min"], columns["max"]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        fraction = numpy.where(maximum > minimum, (maximum - threshold) / (maximum - minimum),
+            (minimum > threshold).astype(numpy.float64))
+    return numpy.nan_to_num(numpy.clip(fraction, 0, 1)) * step
+
+def compute_statistics(columns, bucket_index, bucket_count, statistics, step, threshold, raw):
+    averages = columns["avg"]
+    valid = ~numpy.isnan(averages)
+
+    result = {}
+    for name in statistics:
+        if name == "min":
+            values = reduce_buckets(numpy.fmin, columns["min"], bucket_index, bucket_count)
+        elif name == "max":
+            values = reduce_buckets(numpy.fmax, columns["max"], bucket_index, bucket_count)
+        elif name == "mean":
+            total = reduce_buckets(numpy.add, numpy.where(valid, averages, 0), bucket_index, bucket_count, 0)
+            count = reduce_buckets(numpy.add, valid.astype(numpy.float64), bucket_index, bucket_count, 0)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                values = numpy.where(count > 0, total / count, numpy.nan)
+        elif name == "count":
+            values = reduce_buckets(numpy.add, valid.astype(numpy.float64), bucket_index, bucket_count, 0)
+        elif name == "timeAbove":
+            above = time_above(columns, threshold, step, raw)
+            values = reduce_buckets(numpy.add, above, bucket_index, bucket_count, 0)
+        else:
+            q = float(PERCENTILE.match(name).group(1))
+            if raw:
+                values = bucket_percentile(averages, bucket_index, bucket_count, q)
+            else:
+                # Averages would flatten the peaks; each rollup's extremes keep them
+                values = bucket_percentile(numpy.concatenate((columns["min"], columns["max"])),
+                    numpy.concatenate((bucket_index, bucket_index)), bucket_count, q)
+        result[name] = to_json(values)
+    return result
+
+def to_json(values):
+    return numpy.where(numpy.isnan(values), None, values).tolist()
+
+def aggregate(history, metric, start_time, end_time, statistics, bucket=None, threshold=None,
+        group_by=None):
+    """
+    Split [start_time, end_time) into buckets of `bucket` seconds (a single one
+    by default) and compute the statistics of metric in each of them,
+    optionally for each state of the group_by metric separately.
+
+    Statistics come from the finest history tier that still covers
+    start_time. Outside the raw tier, points are rollups: min and max use the
+    rollups' min and max, mean and count their averages, percentiles the
+    rollups' min and max values, and timeAbove assumes each rollup's values
+    were spread evenly between its min and max.
+    """
+    parse_statistics(statistics)
+    if "timeAbove" in statistics and threshold is None:
+        raise AggregateError("timeAbove needs a threshold")
+    if group_by is not None and group_by not in GROUPS:
+        raise AggregateError(f"Can't group by '{group_by}'")
+
+    if bucket is None:
+        bucket = end_time - start_time
+    bucket_count = int(numpy.ceil((end_time - start_time) / bucket))
+    if bucket_count > MAX_BUCKETS:
+        raise AggregateError(f"Too many buckets (at most {MAX_BUCKETS})")
+
+    tier = history.select_tier(start_time)
+    raw = tier is history.tiers[0]
+    timestamps, columns = load_series(tier, history.index(metric), start_time, end_time)
+    # Rollups that started before start_time count towards the first bucket
+    bucket_index = numpy.clip(((timestamps - start_time) // bucket).astype(numpy.int64), 0, bucket_count - 1)
+
+    result = {
+        "metric": metric,
+        "from": start_time,
+        "to": end_time,
+        "bucket": bucket,
+        "sourceStep": tier.step,
+        "timestamps": (start_time + numpy.arange(bucket_count) * bucket).tolist(),
+    }
+
+    if group_by is None:
+        result["statistics"] = compute_statistics(columns, bucket_index, bucket_count,
+            statistics, tier.step, threshold, raw)
+        return result
+
+    _, group_columns = load_series(tier, history.index(group_by), start_time, end_time)
+    # Points where the state changed go with the state it was in most of the time
+    state = group_columns["avg"]
+    result["groupBy"] = group_by
+    result["groups"] = {}
+    for name, mask in zip(GROUPS[group_by], (state < 0.5, state >= 0.5)):
+        group = { field: values[mask] for field, values in columns.items() }
+        result["groups"][name] = compute_statistics(group, bucket_index[mask], bucket_count,
+            statistics, tier.step, threshold, raw)
+    return result
@@ -1,15 +1,28 @@
 
-from quart import Blueprint, request, websocket
+from quart import Blueprint, make_response, request, websocket
 import asyncio
+import copy
 import json
-from . import sensors, rpi
+import time
+from collections import deque, namedtuple
+from . import aggregate, encoding, export, logger, metrics, sensors, rpi
+from .aggregate import AggregateError
+from .downsample import DownsampleCache
+from .encoding import Message
+from .sensors import PowerTimeoutError, load_config, CONFIG_FILE
+from .history import History
+from .sampler import Sampler
 
 sensors = sensors.Sensors()
+sampler = Sampler(sensors)
+history = History(sampler.snapshot)
+sampler.add_listener(history.record)
+downsampled_history = DownsampleCache(history)
 
 bp = Blueprint("api", __name__, url_prefix="/api/v1")
 
-def build_fan(index):
-    fan = sensors.case_fans[index]
+def build_fan(snapshot, index):
+    fan = snapshot.case_fans[index]
     return {
         "id": fan.id,
         "name": fan.name,
@@ -17,8 +30,8 @@ def build_fan(index):
         "dutyCycle": fan.duty_cycle
     }
 
-def build_temp(index):
-    temp = sensors.temp
+def build_temp(snapshot, index):
+    temp = snapshot.temp
     return {
         "id": index,
         "name": temp.name,
@@ -26,43 +39,100 @@ def build_temp(index):
         "humidity": temp.humidity
     }
 
-def build_psu():
+def build_psu(snapshot):
     return {
-        "powerState": sensors.psu.power_switch.state,
+        "powerState": snapshot.psu.power_state,
+        "powerOk": snapshot.psu.power_ok,
+    }
+
+def parse_power_state(value):
+    valid_on_values = [1, True, "on"]
+    valid_off_values = [0, False, "off"]
+    if value not in valid_on_values and value not in valid_off_values:
+        return None
+
+    # Convert to boolean
+    return (value in valid_on_values)
+
+def valid_timeout(value):
+    # None means the default timeout
+    if value is None:
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+async def change_power_state(new_state, timeout):
+    if timeout is None:
+        timeout = sensors.power_ok_timeout
+    sampler.post_event("powerState", powerState=new_state)
+    try:
+        elapsed = await sensors.psu.set_power_state(new_state, timeout)
+    finally:
+        sampler.publish()
+    return {
+        "newPowerState": new_state,
         "powerOk": sensors.psu.power_ok.state,
+        "timeToPowerOkMs": elapsed,
     }
 
 @bp.route("/bmc/info")
 async def bmc_info():
-    return rpi.get_system_info()
+    return await rpi.get_system_info()
 
 @bp.route("/bmc/stats")
 async def bmc_stats():
-    return rpi.get_system_stats()
+    return await rpi.get_system_stats()
 
-@bp.route("/state")
-async def get_state():
-    sensors.update_state()
+def build_state(snapshot):
     data = { }
 
     fan_data = []
-    for i in range(len(sensors.case_fans)):
-        fan_data.append(build_fan(i))
+    for i in range(len(snapshot.case_fans)):
+        fan_data.append(build_fan(snapshot, i))
 
     data.update({
+        "timestamp": snapshot.timestamp,
         "caseFans": fan_data,
-        "tempSensor": build_temp(0),
-        "psu": build_psu()
+        "tempSensor": build_temp(snapshot, 0),
+        "psu": build_psu(snapshot)
     })
     return data
 
+# Longest (in ms) a /state request may wait for a newer snapshot
+MAX_STATE_WAIT = 30000
+
+@bp.route("/state")
+async def get_state():
+    # /state?since=<seq>&wait=<ms> waits up to wait ms for a snapshot newer than since
+    snapshot = sampler.snapshot
+    since = request.args.get("since", type=int)
+    if since is not None and since >= snapshot.seq:
+        wait = min(max(request.args.get("wait", 0, type=int), 0), MAX_STATE_WAIT)
+        try:
+            snapshot = await asyncio.wait_for(sampler.wait_for_update(since), wait / 1000)
+        except asyncio.TimeoutError:
+            snapshot = sampler.snapshot
+
+    # Weak, since the timestamp moves on while the readings (and seq) stay the same
+    etag = str(snapshot.seq)
+    if request.if_none_match.contains_weak(etag) or (since is not None and since >= snapshot.seq):
+        response = await make_response("", 304)
+    else:
+        response = await make_response(build_state(snapshot))
+    response.set_etag(etag, weak=True)
+    # The state changes all the time, so caches have to check every time
+    response.cache_control.no_cache = True
+    return response
+
+async def get_system_state():
+    return build_state(sampler.snapshot)
+
 @bp.route("/fans/<int:fan_id>", methods=["GET", "PATCH"])
 async def fan_state(fan_id):
     if fan_id < 0 or fan_id >= len(sensors.case_fans):
         return "Fan not found", 404
 
     if request.method == "GET":
-        return build_fan(fan_id)
+        return build_fan(sampler.snapshot, fan_id)
 
     elif request.method == "PATCH":
         data = await request.get_json()
@@ -72,6 +142,8 @@ async def fan_state(fan_id):
 
         fan = sensors.case_fans[fan_id]
         fan.set_speed(new_duty_cycle)
+        sampler.post_event("fanDutyCycle", fanIds=[fan_id], dutyCycle=new_duty_cycle)
+        sampler.publish()
         return "", 204
 
 @bp.route("/temp/<int:temp_id>")
@@ -81,37 +153,172 @@ async def temp_state(temp_id):
         return "Temp sensor not found", 404
 
     return {
-        "tempSensor": build_temp(0)
+        "tempSensor": build_temp(sampler.snapshot, 0)
     }
 
 @bp.route("/psu", methods=["GET", "PATCH"])
 async def psu_state():
     if request.method == "GET":
-        return build_psu()
+        return build_psu(sampler.snapshot)
 
     elif request.method == "PATCH":
         data = await request.get_json()
-        new_state = data["powerState"]
-        valid_on_values = [1, True, "on"]
-        valid_off_values = [0, False, "off"]
-        if new_state not in valid_on_values and new_state not in valid_off_values:
+        new_state = parse_power_state(data["powerState"])
+        if new_state is None:
             return "Invalid power state", 400
 
-        # Convert to boolean
-        new_state = (new_state in valid_on_values)
         sensors.psu.power_switch.write(new_state)
+        sampler.post_event("powerState", powerState=new_state)
+        sampler.publish()
         return "", 204
 
+@bp.route("/psu/power", methods=["POST"])
+async def psu_power():
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return "Expected a JSON object", 400
+    new_state = parse_power_state(data.get("powerState"))
+    if new_state is None:
+        return "Invalid power state", 400
+    if not valid_timeout(data.get("timeout")):
+        return "Invalid timeout", 400
+
+    try:
+        return await change_power_state(new_state, data.get("timeout"))
+    except PowerTimeoutError as e:
+        return { "message": str(e) }, 504
+    except RuntimeError as e:
+        return { "message": str(e) }, 409
+
+# How far back /history goes when no start time is given, in seconds
+DEFAULT_HISTORY_RANGE = 3600
+
+@bp.route("/history")
+async def get_history():
+    # /history?metric=<name>&from=<epoch seconds>&to=<epoch seconds>&step=<seconds>&maxPoints=<n>
+    metric = request.args.get("metric")
+    if metric is None:
+        return {
+            "metrics": history.metrics
+        }
+    if metric not in history.metrics:
+        return "Unknown metric", 404
+
+    end_time = request.args.get("to", time.time(), type=float)
+    start_time = request.args.get("from", end_time - DEFAULT_HISTORY_RANGE, type=float)
+    step = request.args.get("step", type=float)
+    if start_time >= end_time or (step is not None and step <= 0):
+        return "Invalid time range", 400
+
+    max_points = request.args.get("maxPoints", type=int)
+    if max_points is not None:
+        if max_points < 3:
+            return "maxPoints must be at least 3", 400
+        return downsampled_history.get(metric, start_time, end_time, max_points, step)
+
+    return history.query(metric, start_time, end_time, step)
+
+@bp.route("/history/aggregate")
+async def get_history_aggregate():
+    # /history/aggregate?metric=<name>&from=&to=&bucket=<seconds>&stats=p95,max
+    #     &threshold=<value>&groupBy=psu.powerState
+    metric = request.args.get("metric")
+    if metric not in history.metrics:
+        return "Unknown metric", 404
+
+    end_time = request.args.get("to", time.time(), type=float)
+    start_time = request.args.get("from", end_time - DEFAULT_HISTORY_RANGE, type=float)
+    bucket = request.args.get("bucket", type=float)
+    if start_time >= end_time or (bucket is not None and bucket <= 0):
+        return "Invalid time range", 400
+
+    statistics = request.args.get("stats", "min,mean,max").split(",")
+    try:
+        return aggregate.aggregate(history, metric, start_time, end_time, statistics,
+            bucket=bucket,
+            threshold=request.args.get("threshold", type=float),
+            group_by=request.args.get("groupBy"))
+    except AggregateError as e:
+        return { "message": str(e) }, 400
+
+@bp.route("/history/export")
+async def export_history():
+    # /history/export?format=csv|ndjson&from=&to=&step=&metrics=<name>,<name>
+    format = request.args.get("format", "csv")
+    if format not in export.FORMATS:
+        return "Invalid format", 400
+
+    metrics = request.args.get("metrics")
+    metrics = metrics.split(",") if metrics else history.metrics
+    for metric in metrics:
+        if metric not in history.metrics:
+            return f"Unknown metric '{metric}'", 404
+
+    end_time = request.args.get("to", time.time(), type=float)
+    start_time = request.args.get("from", end_time - DEFAULT_HISTORY_RANGE, type=float)
+    step = request.args.get("step", type=float)
+    if start_time >= end_time or (step is not None and step <= 0):
+        return "Invalid time range", 400
+
+    tier = history.select_tier(start_time, step)
+    compress = request.accept_encodings["gzip"] > 0
+
+    async def send_rows():
+        for chunk in export.export(history, tier, metrics, start_time, end_time, format, compress):
+            yield chunk
+
+    headers = {
+        "Content-Type": export.FORMATS[format],
+        "Content-Disposition": f"attachment; filename=pybmc-history-{tier.step:g}s.{format}",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    response = await make_response(send_rows(), headers)
+    # Multi-day exports take a while to send over a slow link
+    response.timeout = None
+    return response
+
+@bp.route("/psu/transitions")
+async def psu_transitions():
+    return {
+        "transitions": [{
+            "powerOk": t.level,
+            "tick": t.tick,
+            "timestamp": t.timestamp,
+        } for t in sensors.psu.power_ok.transitions]
+    }
+
 #
 # Websocket support
 #
 
 async def set_psu_power_state(new_state):
     sensors.psu.power_switch.write(new_state)
+    sampler.post_event("powerState", powerState=new_state)
+    sampler.publish()
     return {
         "newPowerState": new_state
     }
 
+async def set_psu_power_state_and_wait(new_state, timeout=None):
+    new_state = parse_power_state(new_state)
+    if new_state is None:
+        return {
+            "message": "Invalid power state"
+        }
+    if not valid_timeout(timeout):
+        return {
+            "message": "Invalid timeout"
+        }
+
+    try:
+        return await change_power_state(new_state, timeout)
+    except RuntimeError as e:
+        return {
+            "newPowerState": new_state,
+            "message": str(e)
+        }
+
 async def set_fan_duty_cycle(fan_id, duty_cycle):
     fan_id = int(fan_id)
     if fan_id < 0 or fan_id >= len(sensors.case_fans):
@@ -128,6 +335,8 @@ async def set_fan_duty_cycle(fan_id, duty_cycle):
 
     fan = sensors.case_fans[fan_id]
     fan.set_speed(duty_cycle)
+    sampler.post_event("fanDutyCycle", fanIds=[fan_id], dutyCycle=duty_cycle)
+    sampler.publish()
     return {
         "fanId": fan_id,
         "newDutyCycle": duty_cycle
@@ -152,30 +361,43 @@ async def set_fans_duty_cycle(fan_ids, duty_cycle):
         fan_id = int(fan_id)
         fan = sensors.case_fans[fan_id]
         fan.set_speed(duty_cycle)
+    sampler.post_event("fanDutyCycle", fanIds=[int(fan_id) for fan_id in fan_ids], dutyCycle=duty_cycle)
+    sampler.publish()
 
     return {
         "fanIds": fan_ids,
         "newDutyCycle": duty_cycle
     }
 
-async def websocket_send(data):
-    try:
-        while True:
-            await websocket.send(data)
-    except asyncio.CancelledError:
-        # Handle disconnection here
-        raise
-
 websocket_command_map = {
     "getBmcInfo": bmc_info,
     "getBmcStats": bmc_stats,
-    "getSystemState": get_state,
+    "getSystemState": get_system_state,
     "setPsuPowerState": set_psu_power_state,
+    "setPsuPowerStateAndWait": set_psu_power_state_and_wait,
     "setFanDutyCycle": set_fan_duty_cycle,
     "setFansDutyCycle": set_fans_duty_cycle,
 }
 
-async def dispatch_websocket_request(req):
+def build_websocket_response(req, response_data):
+    if not isinstance(req, dict):
+        req = {}
+    response = {
+        "request": req.get("command"),
+        "response": response_data
+    }
+    # Clients with several requests in flight tell the responses apart by id
+    if "id" in req:
+        response["id"] = req["id"]
+    return response
+
+async def dispatch_websocket_request(req, session):
+    if not isinstance(req, dict):
+        raise RuntimeError("Invalid websocket request")
+
+    if "batch" in req:
+        return await dispatch_websocket_batch(req, session)
+
     if "command" not in req or not req["command"]:
         raise RuntimeError("Invalid websocket request")
 
@@ -184,42 +406,594 @@ async def dispatch_websocket_request(req):
     if "args" in req:
         args = req["args"]
 
-    callback = websocket_command_map.get(cmd)
+    # Subscriptions belong to the connection, so those commands go to its session
+    callback = session.command_map.get(cmd) or websocket_command_map.get(cmd)
+    if callback is None:
+        raise RuntimeError(f"Unknown command '{cmd}'")
+
     response_data = await callback(*args)
-    return {
-        "request": cmd,
-        "response": response_data
+    return build_websocket_response(req, response_data)
+
+# Responses that have a compact form, for the codecs that use it
+compact_responses = {
+    "getSystemState": encoding.compact_state,
+}
+
+def build_websocket_message(response_data):
+    compact = compact_responses.get(response_data.get("request"))
+    if compact is None or "message" in response_data["response"]:
+        return Message(response_data)
+    return Message(response_data,
+        lambda: dict(response_data, response=compact(response_data["response"])))
+
+async def dispatch_websocket_batch(req, session):
+    """
+    Run the commands in req["batch"] one after the other (so they're applied
+    in order) and return all of their responses in a single frame.
+    """
+    responses = []
+    for item in req["batch"]:
+        try:
+            responses.append(await dispatch_websocket_request(item, session))
+        except Exception as e:
+            responses.append(build_websocket_response(item, { "message": str(e) }))
+
+    response = {
+        "batch": responses
     }
+    if "id" in req:
+        response["id"] = req["id"]
+    return response
+
+# Requests a client can have in flight before we stop reading from it
+MAX_PENDING_REQUESTS = 8
+
+# Smallest interval (in ms) a subscriber may ask updates to be pushed at
+MIN_PUSH_INTERVAL = 50
+
+# Pushed frames a client can fall behind by before the oldest are dropped
+OUTBOX_SIZE = 16
+
+def is_changed(old, new, deadband):
+    if deadband and isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return abs(new - old) >= deadband
+    return old != new
+
+def diff_state(baseline, state, deadbands):
+    """
+    Return the fields of state that changed since baseline, and update
+    baseline with them. Numbers that moved less than the deadband configured
+    for their key don't count as changed. Lists are diffed item by item and
+    reported as { index: changes }.
+    """
+    changes = {}
+    for key, value in state.items():
+        old = baseline.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            change = diff_state(old, value, deadbands)
+        elif isinstance(value, list) and isinstance(old, list) and len(value) == len(old):
+            change = {}
+            for i, (old_item, item) in enumerate(zip(old, value)):
+                item_change = diff_state(old_item, item, deadbands)
+                if item_change:
+                    change[i] = item_change
+        elif is_changed(old, value, deadbands.get(key)):
+            baseline[key] = copy.deepcopy(value)
+            changes[key] = value
+            continue
+        else:
+            continue
+
+        if change:
+            changes[key] = change
+    return changes
+
+class Outbox:
+    """
+    Bounded queue of messages waiting to be sent to one client. Frames
+    of topics that only matter in their latest version replace the unsent
+    one of the same topic, and when the queue is full the oldest pushed
+    frame is dropped, so a stalled client never holds on to more than
+    OUTBOX_SIZE frames. Replies to requests are never dropped; instead,
+    `sent` is called once one is taken out to be sent, which the session
+    uses to stop reading requests while too many replies are waiting.
+
+    Delta frames only make sense on top of the previous one, so they come
+    with a resync function returning a full frame; whenever a delta would be
+    lost, the client gets a full frame instead.
+    """
+
+    def __init__(self, codec=encoding.JSON, size=OUTBOX_SIZE) -> None:
+        self.codec = codec
+        # [topic, message, resync, sent]
+        self._frames = deque()
+        self._size = size
+        self._ready = asyncio.Event()
+        # Delta topics that lost a frame and need a full one next
+        self._stale = set()
+        self.dropped = 0
+
+    def put(self, frame, topic=None, latest_wins=False, resync=None, sent=None):
+        if topic in self._stale:
+            self._stale.discard(topic)
+            frame = resync()
+
+        if latest_wins:
+            for entry in self._frames:
+                if entry[0] == topic:
+                    entry[1] = frame if resync is None else resync()
+                    entry[2] = resync
+                    self.dropped += 1
+                    return
+
+        if topic is not None and len(self._frames) >= self._size:
+            for i, (queued_topic, _, queued_resync, _) in enumerate(self._frames):
+                if queued_topic is not None:
+                    del self._frames[i]
+                    self.dropped += 1
+                    if queued_resync is not None:
+                        self._stale.add(queued_topic)
+                    break
+
+        self._frames.append([topic, frame, resync, sent])
+        self._ready.set()
+
+    async def get(self):
+        """Return the next frame to send, encoded for this client."""
+        while not self._frames:
+            self._ready.clear()
+            await self._ready.wait()
+        _, frame, _, sent = self._frames.popleft()
+        if sent is not None:
+            sent()
+        return frame.encode(self.codec)
+
+
+class Channel:
+    def __init__(self, topic, latest_wins, delta) -> None:
+        self.topic = topic
+        self.latest_wins = latest_wins
+        self.outboxes = set()
+        self.frame = None
+        self.task = None
+
+        # Delta channels: what their subscribers were last told, and its sequence number
+        self.delta = delta
+        self.seq = 0
+        self.baseline = None
+        self._full_frame = None
+
+    def update_baseline(self, state, deadbands):
+        """Fold state into the baseline and return the delta, or None if nothing changed."""
+        state = dict(state)
+        timestamp = state.pop("timestamp", None)
+        if self.baseline is None:
+            self.baseline = copy.deepcopy(state)
+            changes = state
+        else:
+            changes = diff_state(self.baseline, state, deadbands)
+            if not changes:
+                return None
+
+        self.seq += 1
+        self.baseline["timestamp"] = timestamp
+        changes["timestamp"] = timestamp
+        self._full_frame = None
+        return changes
+
+    def full_frame(self):
+        if self._full_frame is None:
+            # The baseline keeps changing, and the frame may be encoded later
+            frame = {
+                "topic": self.topic,
+                "seq": self.seq,
+                "data": copy.deepcopy(self.baseline)
+            }
+            self._full_frame = Message(frame,
+                lambda: dict(frame, data=encoding.compact_state(frame["data"])))
+        return self._full_frame
+
+
+class BroadcastHub:
+    """
+    Produces the updates of each topic once, no matter how many clients
+    subscribed to it: every update is encoded a single time and the same
+    frame is handed to the outbox of each subscriber.
+
+    Topics that support it can be subscribed to in "delta" mode: subscribers
+    get a full frame first and then only the fields that changed, each frame
+    numbered by seq so clients can tell when they missed one and resync.
+    """
+
+    def __init__(self) -> None:
+        swconfig = load_config(CONFIG_FILE)
+        websocket_config = swconfig["pybmc"].get("websocket", {})
+        self._deadbands = websocket_config.get("deadbands", {})
+
+        # (topic, interval in ms, mode) -> Channel
+        self._channels = {}
+        self._delta_topics = { "systemState" }
+        self._topics = {
+            # topic: (producer, default interval in ms, latest wins)
+            "systemState": (self._produce_system_state, 250, True),
+            "bmcStats": (self._produce_bmc_stats, 1000, True),
+            # Events are pushed as they happen, and every one of them matters
+            "events": (self._produce_events, None, False),
+        }
+
+    def has_topic(self, topic):
+        return topic in self._topics
+
+    def has_mode(self, topic, mode):
+        return mode == "full" or (mode == "delta" and topic in self._delta_topics)
+
+    def subscribe(self, topic, interval_ms, mode, outbox):
+        """Add outbox to the topic's subscribers. Returns the key to unsubscribe with."""
+        produce, default_interval, latest_wins = self._topics[topic]
+        if default_interval is None:
+            interval_ms = None
+        else:
+            if interval_ms is None:
+                interval_ms = default_interval
+            interval_ms = max(int(interval_ms), MIN_PUSH_INTERVAL)
+
+        key = (topic, interval_ms, mode)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = Channel(topic, latest_wins, mode == "delta")
+            self._channels[key] = channel
+            channel.task = asyncio.create_task(produce(channel, interval_ms))
+
+        channel.outboxes.add(outbox)
+        # Don't make new subscribers wait for the next update
+        if channel.delta:
+            self.resync(key, outbox)
+        elif channel.frame is not None:
+            outbox.put(channel.frame, topic, latest_wins)
+        return key
+
+    def resync(self, key, outbox):
+        """Send the full state of a delta channel to outbox. Returns its seq."""
+        channel = self._channels[key]
+        if channel.baseline is not None:
+            outbox.put(channel.full_frame(), channel.topic, True, channel.full_frame)
+        return channel.seq
+
+    def unsubscribe(self, key, outbox):
+        channel = self._channels.get(key)
+        if channel is None:
+            return
+
+        channel.outboxes.discard(outbox)
+        if not channel.outboxes:
+            channel.task.cancel()
+            del self._channels[key]
+
+    def _broadcast(self, channel, data, compact=None):
+        update = {
+            "topic": channel.topic,
+            "data": data
+        }
+        if compact is None:
+            frame = Message(update)
+        else:
+            frame = Message(update, lambda: dict(update, data=compact(data)))
+        if channel.latest_wins:
+            channel.frame = frame
+        for outbox in channel.outboxes:
+            outbox.put(frame, channel.topic, channel.latest_wins)
+
+    def _broadcast_delta(self, channel, data):
+        first = channel.baseline is None
+        changes = channel.update_baseline(data, self._deadbands)
+        if changes is None:
+            return
+
+        if first:
+            frame = channel.full_frame()
+        else:
+            delta = {
+                "topic": channel.topic,
+                "seq": channel.seq,
+                "delta": True,
+                "data": changes
+            }
+            frame = Message(delta, lambda: dict(delta, data=encoding.compact_delta(changes)))
+        for outbox in channel.outboxes:
+            outbox.put(frame, channel.topic, channel.latest_wins, channel.full_frame)
+
+    async def _produce_system_state(self, channel, interval_ms):
+        interval = interval_ms / 1000
+        seq = 0
+        while True:
+            snapshot = await sampler.wait_for_update(seq)
+            seq = snapshot.seq
+            if channel.delta:
+                self._broadcast_delta(channel, build_state(snapshot))
+            else:
+                self._broadcast(channel, build_state(snapshot), encoding.compact_state)
+            await asyncio.sleep(interval)
+
+    async def _produce_bmc_stats(self, channel, interval_ms):
+        interval = interval_ms / 1000
+        while True:
+            self._broadcast(channel, await rpi.get_system_stats())
+            await asyncio.sleep(interval)
+
+    def _produce_events(self, channel, interval_ms):
+        # Subscribe right away, so events posted by the next request aren't missed
+        return self._relay_events(channel, sampler.subscribe_events())
+
+    async def _relay_events(self, channel, queue):
+        try:
+            while True:
+                self._broadcast(channel, await queue.get())
+        finally:
+            sampler.unsubscribe_events(queue)
+
+hub = BroadcastHub()
+
+# Updates kept around for Server-Sent Events clients resuming with Last-Event-ID
+STREAM_REPLAY_SIZE = 256
+
+# Seconds a topic keeps being recorded after its last stream client left,
+# so clients that reconnect can catch up on what they missed
+STREAM_LINGER = 60
+
+StreamEntry = namedtuple("StreamEntry", ["id", "topic", "text"])
+
+class StreamLog:
+    """
+    Records the updates of the topics streamed over Server-Sent Events in a
+    small replay buffer. Every update gets an id and is formatted once, and
+    all stream clients read from the same buffer, catching up from the
+    Last-Event-ID they had when reconnecting.
+    """
+
+    def __init__(self, hub) -> None:
+        self._hub = hub
+        self._entries = deque(maxlen=STREAM_REPLAY_SIZE)
+        # Like snapshot sequence numbers, ids keep increasing across restarts
+        self._next_id = int(time.time() * 1000)
+        self._updated = asyncio.Event()
+        # topic -> latest entry, for topics where only the latest update matters
+        self._latest = {}
+        # topic -> [hub key, clients, linger timer]
+        self._topics = {}
+
+    def put(self, message, topic, latest_wins=False, resync=None):
+        text = f"id: {self._next_id}\nevent: {topic}\ndata: {json.dumps(message.data['data'])}\n\n"
+        entry = StreamEntry(self._next_id, topic, text)
+        self._next_id += 1
+        self._entries.append(entry)
+        if latest_wins:
+            self._latest[topic] = entry
+
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def acquire(self, topics):
+        for topic in topics:
+            subscription = self._topics.get(topic)
+            if subscription is None:
+                key = self._hub.subscribe(topic, None, "full", self)
+                subscription = [key, 0, None]
+                self._topics[topic] = subscription
+            elif subscription[2] is not None:
+                subscription[2].cancel()
+                subscription[2] = None
+            subscription[1] += 1
+
+    def release(self, topics):
+        loop = asyncio.get_running_loop()
+        for topic in topics:
+            subscription = self._topics[topic]
+            subscription[1] -= 1
+            if subscription[1] == 0:
+                subscription[2] = loop.call_later(STREAM_LINGER, self._expire, topic)
+
+    def _expire(self, topic):
+        key, _, _ = self._topics.pop(topic)
+        self._hub.unsubscribe(key, self)
+        self._latest.pop(topic, None)
+
+    async def follow(self, topics, last_event_id=None, heartbeat=None):
+        """
+        Yield the entries of the given topics as they come in, starting after
+        last_event_id, or with the latest state when there's none. Yields
+        None when none came in for `heartbeat` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        if last_event_id is None:
+            last_event_id = self._next_id - 1
+            for entry in sorted(self._latest.values()):
+                if entry.topic in topics:
+                    yield entry
+        last_yield = loop.time()
 
-async def websocket_receive():
-    try:
+        while True:
+            entries = [entry for entry in self._entries if entry.id > last_event_id]
+            for entry in entries:
+                last_event_id = entry.id
+                if entry.topic in topics:
+                    yield entry
+                    last_yield = loop.time()
+
+            timeout = last_yield + heartbeat - loop.time()
+            try:
+                if timeout > 0:
+                    await asyncio.wait_for(self._updated.wait(), timeout)
+                    continue
+            except asyncio.TimeoutError:
+                pass
+            yield None
+            last_yield = loop.time()
+
+stream_log = StreamLog(hub)
+
+class WebsocketSession:
+    """
+    State of one websocket connection. Requests are dispatched concurrently
+    as they come in, so a slow one (waiting for power ok, say) doesn't hold
+    back the rest, while the topics it subscribed to are pushed by the
+    broadcast hub.
+    """
+
+    def __init__(self, codec=encoding.JSON) -> None:
+        self._codec = codec
+        self._outbox = Outbox(codec)
+        self._subscriptions = {}
+        self._pending = asyncio.Semaphore(MAX_PENDING_REQUESTS)
+        self._requests = set()
+        self.command_map = {
+            "subscribe": self.subscribe,
+            "unsubscribe": self.unsubscribe,
+            "resync": self.resync,
+        }
+
+    async def run(self):
+        producer = asyncio.create_task(self._send())
+        consumer = asyncio.create_task(self._receive())
+        try:
+            await asyncio.gather(producer, consumer)
+        finally:
+            producer.cancel()
+            consumer.cancel()
+            for task in self._requests:
+                task.cancel()
+            for key in self._subscriptions.values():
+                hub.unsubscribe(key, self._outbox)
+            self._subscriptions = {}
+
+    async def subscribe(self, topic, interval_ms=None, mode="full"):
+        if not hub.has_topic(topic):
+            return {
+                "topic": topic,
+                "message": "Unknown topic"
+            }
+        if not hub.has_mode(topic, mode):
+            return {
+                "topic": topic,
+                "message": f"Mode '{mode}' not supported"
+            }
+
+        await self.unsubscribe(topic)
+        key = hub.subscribe(topic, interval_ms, mode, self._outbox)
+        self._subscriptions[topic] = key
+        return {
+            "topic": topic,
+            "intervalMs": key[1],
+            "mode": mode
+        }
+
+    async def resync(self, topic):
+        key = self._subscriptions.get(topic)
+        if key is None or key[2] != "delta":
+            return {
+                "topic": topic,
+                "message": "Not subscribed in delta mode"
+            }
+
+        return {
+            "topic": topic,
+            "seq": hub.resync(key, self._outbox)
+        }
+
+    async def unsubscribe(self, topic):
+        key = self._subscriptions.pop(topic, None)
+        if key is not None:
+            hub.unsubscribe(key, self._outbox)
+        return {
+            "topic": topic
+        }
+
+    async def _send(self):
+        while True:
+            await websocket.send(await self._outbox.get())
+
+    async def _receive(self):
         while True:
             data = await websocket.receive()
-            request_data = json.loads(data)
-            response_data = dispatch_websocket_request(request_data)
-            await websocket.send(json.dumps(response_data))
-    except asyncio.CancelledError:
-        # Handle disconnection here
-        raise
+            # Every request holds a slot until its reply leaves the outbox
+            await self._pending.acquire()
+            try:
+                request_data = self._codec.decode(data)
+            except Exception as e:
+                logger.log(f"Can't decode websocket request: {e!r}")
+                response_data = build_websocket_response(None, { "message": f"Malformed request: {e}" })
+                self._reply(response_data)
+                continue
+            task = asyncio.create_task(self._handle(request_data))
+            self._requests.add(task)
+            task.add_done_callback(self._requests.discard)
+
+    async def _handle(self, request_data):
+        start = time.perf_counter()
+        try:
+            response_data = await dispatch_websocket_request(request_data, self)
+        except Exception as e:
+            logger.log(f"Websocket request {request_data!r} failed: {e!r}")
+            response_data = build_websocket_response(request_data, { "message": str(e) })
+        command = request_data.get("command") if isinstance(request_data, dict) else None
+        if not isinstance(command, str) or (command not in websocket_command_map and
+                command not in self.command_map):
+            command = "unknown"
+        metrics.request_latency.observe("websocket", command, time.perf_counter() - start)
+        self._reply(response_data)
+
+    def _reply(self, response_data):
+        self._outbox.put(build_websocket_message(response_data), sent=self._pending.release)
 
 @bp.websocket("/ws")
 async def handle_websocket():
+    codec, subprotocol = encoding.negotiate(websocket.requested_subprotocols)
+    await websocket.accept(subprotocol=subprotocol)
     try:
-        while True:
-            data = await websocket.receive()
-            request_data = json.loads(data)
-            response_data = await dispatch_websocket_request(request_data)
-            await websocket.send(json.dumps(response_data))
+        await WebsocketSession(codec).run()
     except asyncio.CancelledError:
         # Handle disconnection here
         raise
 
-# @bp.websocket("/ws")
-# async def handle_websocket():
-#     try:
-#         producer = asyncio.create_task(websocket_send())
-#         consumer = asyncio.create_task(websocket_receive())
-#         await asyncio.gather(producer, consumer)
-#     except asyncio.CancelledError:
-#         # Handle disconnection here
-#         raise
+#
+# Server-Sent Events
+#
+
+# Seconds between keep-alive comments on an idle stream
+STREAM_HEARTBEAT = 15
+
+STREAM_DEFAULT_TOPICS = "systemState,events"
+
+@bp.route("/stream")
+async def stream():
+    # /stream?topics=systemState,events,bmcStats
+    topics = set(request.args.get("topics", STREAM_DEFAULT_TOPICS).split(","))
+    for topic in topics:
+        if not hub.has_topic(topic):
+            return f"Unknown topic '{topic}'", 400
+
+    # Browsers resend the last id they got when reconnecting; other clients
+    # may pass it in the query string
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("lastEventId"))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return "Invalid Last-Event-ID", 400
+
+    async def send_events():
+        stream_log.acquire(topics)
+        try:
+            async for entry in stream_log.follow(topics, last_event_id, STREAM_HEARTBEAT):
+                if entry is None:
+                    yield b": heartbeat\n\n"
+                else:
+                    yield entry.text.encode()
+        finally:
+            stream_log.release(topics)
+
+    response = await make_response(send_events(), {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+    })
+    # Streams stay open for as long as the client wants
+    response.timeout = None
+    return response
@@ -1,8 +1,9 @@
 
 import os
+import time
 
-from quart import Quart, render_template
-from . import version
+from quart import Quart, g, render_template, request
+from . import metrics, rpi, version
 
 def create_app(test_config=None):
     app = Quart(__name__.split('.')[0], instance_relative_config=True)
@@ -26,11 +27,43 @@ def create_app(test_config=None):
     from . import api
     app.register_blueprint(api.bp)
 
+    @app.before_serving
+    async def start_sampler():
+        api.sampler.start()
+
+    @app.after_serving
+    async def stop_sampler():
+        await api.sampler.stop()
+        api.history.flush()
+
+    @app.before_request
+    async def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    async def observe_request_latency(response):
+        # For streamed responses, this is the time to the first byte
+        rule = request.url_rule.rule if request.url_rule is not None else "unknown"
+        metrics.request_latency.observe("http", rule, time.perf_counter() - g.request_start)
+        return response
+
+    snapshot_metrics = None
+
+    @app.route("/metrics")
+    async def get_metrics():
+        nonlocal snapshot_metrics
+        snapshot = api.sampler.snapshot
+        if snapshot_metrics is None:
+            snapshot_metrics = metrics.SnapshotMetrics(snapshot)
+        body = metrics.render(snapshot_metrics, snapshot, rpi.peek_system_stats(metrics.PI_STATS_MAX_AGE))
+        return body, 200, { "Content-Type": metrics.CONTENT_TYPE }
+
     @app.route("/")
     async def index():
         project_name = __name__.split('.')[0]
         project_version = version.__version__
-        sensors = api.sensors
+        sync_fans_speeds = api.sensors.sync_fans_speeds
+        snapshot = api.sampler.snapshot
         return await render_template("main.html", **locals())
 
     return app
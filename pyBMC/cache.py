@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+class SingleFlight:
+    """
+    Runs at most one call of a coroutine function at a time. Callers that
+    arrive while a call is in flight wait for it and share its result.
+    """
+
+    def __init__(self) -> None:
+        self._task = None
+
+    async def run(self, func, *args):
+        if self._task is None:
+            self._task = asyncio.ensure_future(func(*args))
+            self._task.add_done_callback(self._on_done)
+        # A caller giving up must not cancel the call for everybody else
+        return await asyncio.shield(self._task)
+
+    def _on_done(self, task):
+        self._task = None
+
+
+class TtlCache:
+    """Values that expire after their own time-to-live (in seconds)."""
+
+    def __init__(self) -> None:
+        self._entries = {}
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl):
+        now = time.monotonic()
+        self._entries[key] = (value, now + ttl, now)
+
+    def peek(self, key, default=None):
+        """Return the last value stored for key, even if it has expired."""
+        entry = self._entries.get(key)
+        return default if entry is None else entry[0]
+
+    def age(self, key):
+        """Return how long ago (in seconds) key was stored, or None if it never was."""
+        entry = self._entries.get(key)
+        return None if entry is None else time.monotonic() - entry[2]
+
+    def expired(self, keys):
+        now = time.monotonic()
+        return [key for key in keys
+            if key not in self._entries or self._entries[key][1] <= now]
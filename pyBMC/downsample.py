@@ -0,0 +1,107 @@
+#
+# Chart-ready history: Largest-Triangle-Three-Buckets downsampling
+#
+
+from collections import OrderedDict
+import numpy
+from .aggregate import load_series, to_json
+
+# Downsampled series kept around for dashboards redrawing the same range
+CACHE_SIZE = 64
+
+def lttb(x, y, max_points):
+    """
+    Return the indices of the (at most) max_points points that best preserve
+    the shape of the series, per Largest-Triangle-Three-Buckets: keep the
+    first and last points, and from each bucket in between the point forming
+    the largest triangle with the point kept before it and the average of
+    the next bucket. Bucket bounds and averages are computed up front, so
+    only the choice within each bucket is left to the loop.
+    """
+    count = len(x)
+    if max_points >= count or max_points < 3:
+        return numpy.arange(count)
+
+    every = (count - 2) / (max_points - 2)
+    edges = numpy.append(numpy.floor(numpy.arange(max_points - 2) * every).astype(numpy.int64) + 1, count - 1)
+    starts = edges[:-1]
+    ends = edges[1:]
+    sizes = ends - starts
+
+    # The average point of the bucket after each one (the last point, after the last bucket)
+    next_x = numpy.append((numpy.add.reduceat(x[:count - 1], starts) / sizes)[1:], x[-1])
+    next_y = numpy.append((numpy.add.reduceat(y[:count - 1], starts) / sizes)[1:], y[-1])
+
+    selected = numpy.empty(max_points, dtype=numpy.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = starts[i], ends[i]
+        areas = numpy.abs((x[a] - next_x[i]) * (y[start:end] - y[a]) -
+            (x[a] - x[start:end]) * (next_y[i] - y[a]))
+        a = start + int(numpy.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+def downsample(history, metric, start_time, end_time, max_points, step=None):
+    """
+    Like History.query(), but with at most max_points points, picked by LTTB
+    on the averages. Points with no reading are left out.
+    """
+    tier = history.select_tier(start_time, step)
+    timestamps, columns = load_series(tier, history.index(metric), start_time, end_time)
+    valid = numpy.flatnonzero(~numpy.isnan(columns["avg"]))
+    selected = valid[lttb(timestamps[valid], columns["avg"][valid], max_points)]
+
+    result = {
+        "metric": metric,
+        "from": start_time,
+        "to": end_time,
+        "step": tier.step,
+        "maxPoints": max_points,
+        "timestamps": timestamps[selected].tolist(),
+    }
+    for field, values in columns.items():
+        result[field] = to_json(values[selected])
+    return result
+
+
+class DownsampleCache:
+    """
+    Least recently used downsampled series. Ranges are aligned to the step
+    of the tier they're read from, so they end where a bucket starts. A
+    series that still reaches into the bucket being filled changes with
+    every sample, so it's only reused until the next one is recorded; older
+    ranges are settled and stay valid.
+    """
+
+    def __init__(self, history, size=CACHE_SIZE) -> None:
+        self._history = history
+        self._size = size
+        self._entries = OrderedDict()
+
+    def get(self, metric, start_time, end_time, max_points, step=None):
+        history = self._history
+        # Align the range to the tier's buckets, so dashboards asking for
+        # "the last hour" every few seconds get the same key until a bucket closes
+        tier = history.select_tier(start_time, step)
+        start_time -= start_time % tier.step
+        end_time -= end_time % tier.step
+        if end_time <= start_time:
+            end_time = start_time + tier.step
+        key = (metric, start_time, end_time, max_points, step)
+        entry = self._entries.get(key)
+        if entry is not None:
+            generation, result = entry
+            if generation is None or generation == history.generation:
+                self._entries.move_to_end(key)
+                return result
+
+        result = downsample(history, metric, start_time, end_time, max_points, step)
+        generation = None if tier.settled(end_time) else history.generation
+        self._entries[key] = (generation, result)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+        return result
@@ -0,0 +1,120 @@
+#
+# Websocket message encodings
+#
+# JSON is the default. Clients that want less CPU and bandwidth spent on
+# encoding can ask for a binary one (MessagePack or CBOR) through the
+# Sec-WebSocket-Protocol header, provided its package is installed.
+#
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Binary encodings send compact system states, where each fan, the temp sensor
+# and the PSU are arrays with their fields in this order instead of objects.
+# Their deltas key the changed fields by the same positions.
+FAN_FIELDS = ("id", "name", "rpm", "dutyCycle")
+TEMP_FIELDS = ("id", "name", "temperatureC", "humidity")
+PSU_FIELDS = ("powerState", "powerOk")
+
+def compact_state(state):
+    return {
+        "timestamp": state["timestamp"],
+        "caseFans": [[fan[field] for field in FAN_FIELDS] for fan in state["caseFans"]],
+        "tempSensor": [state["tempSensor"][field] for field in TEMP_FIELDS],
+        "psu": [state["psu"][field] for field in PSU_FIELDS],
+    }
+
+def compact_fields(changes, fields):
+    return { fields.index(field): value for field, value in changes.items() }
+
+def compact_delta(changes):
+    """
+    Compact form of a system state delta: changed fields are keyed by their
+    position in the compact state instead of their name.
+    """
+    compact = {}
+    for key, value in changes.items():
+        if key == "caseFans":
+            if isinstance(value, list):
+                # The set of fans changed, so they're all sent
+                value = [[fan[field] for field in FAN_FIELDS] for fan in value]
+            else:
+                value = { i: compact_fields(fan, FAN_FIELDS) for i, fan in value.items() }
+        elif key == "tempSensor":
+            value = compact_fields(value, TEMP_FIELDS)
+        elif key == "psu":
+            value = compact_fields(value, PSU_FIELDS)
+        compact[key] = value
+    return compact
+
+
+class Codec:
+    def __init__(self, subprotocol, binary, encode, decode) -> None:
+        self.subprotocol = subprotocol
+        self.binary = binary
+        # Binary clients are machines, so they get the compact state
+        self.compact = binary
+        self._encode = encode
+        self._decode = decode
+
+    def encode(self, data):
+        return self._encode(data)
+
+    def decode(self, data):
+        if isinstance(data, str):
+            # Text frames are always JSON
+            return json.loads(data)
+        return self._decode(data)
+
+
+JSON = Codec("json", False, json.dumps, json.loads)
+
+CODECS = { "json": JSON }
+if msgpack is not None:
+    CODECS["msgpack"] = Codec("msgpack", True, msgpack.packb, msgpack.unpackb)
+if cbor2 is not None:
+    CODECS["cbor"] = Codec("cbor", True, cbor2.dumps, cbor2.loads)
+
+def negotiate(requested_subprotocols):
+    """
+    Pick the first of the client's subprotocols we support. Returns the codec
+    and the subprotocol to accept (None when the client didn't ask for any).
+    """
+    for subprotocol in requested_subprotocols:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return JSON, None
+
+
+class Message:
+    """
+    A message to send to one or more clients. It's encoded at most once per
+    codec, no matter how many clients it goes to. `compact` is a function
+    returning an alternative form of the data, for codecs that send compact
+    states; it's only called if one of them needs it.
+    """
+
+    def __init__(self, data, compact=None) -> None:
+        self.data = data
+        self._compact = compact
+        self._encoded = {}
+
+    def encode(self, codec):
+        encoded = self._encoded.get(codec.subprotocol)
+        if encoded is None:
+            data = self.data
+            if codec.compact and self._compact is not None:
+                data = self._compact()
+            encoded = codec.encode(data)
+            self._encoded[codec.subprotocol] = encoded
+        return encoded
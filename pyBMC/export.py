@@ -0,0 +1,66 @@
+#
+# Streaming export of the sensor history as CSV or NDJSON
+#
+
+import csv
+import io
+import json
+import math
+import zlib
+from .history import FIELDS
+
+# Rows read from the history (and formatted) at a time
+CHUNK_ROWS = 1024
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+def column_names(metrics):
+    return ["timestamp"] + [f"{metric}.{field}" for metric in metrics for field in FIELDS]
+
+def format_csv(names, rows, header):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    if header:
+        writer.writerow(names)
+    for row in rows:
+        writer.writerow(["" if value != value else value for value in row])
+    return output.getvalue()
+
+def format_ndjson(names, rows, header):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps({ name: None if math.isnan(value) else value
+            for name, value in zip(names, row) }))
+        lines.append("\n")
+    return "".join(lines)
+
+def export(history, tier, metrics, start_time, end_time, format, compress=False):
+    """
+    Generate the rows of the given metrics in [start_time, end_time) from one
+    history tier, CHUNK_ROWS at a time, formatted (and gzipped if compress)
+    as they go. Memory use stays the same no matter how long the range is.
+    """
+    formatter = format_csv if format == "csv" else format_ndjson
+    names = column_names(metrics)
+    indexes = [history.index(metric) for metric in metrics]
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    header = True
+    for timestamps, columns in tier.chunks(indexes, start_time, end_time, CHUNK_ROWS):
+        series = [columns[field][i] for i in range(len(metrics)) for field in FIELDS]
+        text = formatter(names, zip(timestamps, *series), header).encode()
+        header = False
+        if compressor is not None:
+            text = compressor.compress(text)
+        if text:
+            yield text
+
+    if header and format == "csv":
+        # Nothing in range, still send the header
+        text = formatter(names, [], True).encode()
+        yield compressor.compress(text) if compressor is not None else text
+    if compressor is not None:
+        yield compressor.flush()
@@ -0,0 +1,20 @@
+import os
+import pigpio
+from . import logger
+
+# Overrides the backend chosen in pybmc.conf
+BACKEND_VARIABLE = "PYBMC_BACKEND"
+
+def create_pi(swconfig, hwconfig):
+    """Return the pigpio.pi (or a stand-in for it) pyBMC should talk to."""
+    hardware = swconfig["pybmc"].get("hardware", {})
+    backend = os.environ.get(BACKEND_VARIABLE) or hardware.get("backend", "pigpio")
+    logger.log(f"Using {backend} hardware backend")
+
+    if backend == "pigpio":
+        return pigpio.pi()
+    elif backend == "simulated":
+        from .simulator import SimulatedPi
+        return SimulatedPi(hwconfig["pybmc"], hardware.get("simulation", {}))
+
+    raise RuntimeError(f"Unknown hardware backend '{backend}'")
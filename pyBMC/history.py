@@ -0,0 +1,554 @@
+#
+# Fixed-memory, multi-resolution history of the sensor readings (RRD style)
+#
+
+import asyncio
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from . import logger
+from .sensors import load_config, CONFIG_FILE
+
+NAN = float("nan")
+
+# Where files pyBMC generates go when pybmc.conf doesn't say
+DEFAULT_DATA_DIR = "data"
+
+# Overrides the history file set in pybmc.conf (empty keeps the history in memory)
+FILE_VARIABLE = "PYBMC_HISTORY_FILE"
+
+# Raw samples, then 10 second, 1 minute and 10 minute rollups
+DEFAULT_SETTINGS = {
+    "file": None,
+    "flush-interval": 300,
+    "interval": 0.25,
+    "raw-retention": 600,
+    "tiers": [
+        { "step": 10, "retention": 86400 },
+        { "step": 60, "retention": 604800 },
+        { "step": 600, "retention": 7776000 },
+    ],
+}
+
+FIELDS = ("min", "avg", "max")
+
+class SeriesRing:
+    """
+    Ring of rows, each made of a timestamp and a min/avg/max triplet per
+    metric. All storage is allocated up front: values are float32, laid out
+    metric by metric so a metric's history is a contiguous slice. Storage
+    is either arrays or, when given, views of a HistoryFile's buffer.
+    """
+
+    def __init__(self, capacity, metric_count, storage=None) -> None:
+        self.capacity = capacity
+        if storage is None:
+            self.timestamps = array("d", [0.0]) * capacity
+            self.columns = { field: array("f", [NAN]) * (capacity * metric_count) for field in FIELDS }
+        else:
+            self.timestamps, self.columns = storage
+        self._next = 0
+        self._count = 0
+        # Rows added since the last take_unsaved()
+        self._unsaved = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        # Timestamps in chronological order, for bisect
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self.timestamps[self.slot(index)]
+
+    @property
+    def full(self):
+        return self._count == self.capacity
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column)
+            for column in (self.timestamps, *self.columns.values()))
+
+    @property
+    def cursor(self):
+        return (self._next, self._count)
+
+    def restore(self, cursor):
+        """
+        Pick up rows stored by a previous run. Rows written after the cursor
+        was saved are kept too, as long as their timestamps are in order.
+        """
+        self._next, self._count = cursor
+        newest = self[self._count - 1] if self._count else 0.0
+        for _ in range(self.capacity):
+            timestamp = self.timestamps[self._next]
+            if timestamp <= newest:
+                break
+            newest = timestamp
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+        self._unsaved = 0
+
+    def slot(self, index):
+        return (self._next - self._count + index) % self.capacity
+
+    def append(self, timestamp):
+        """Add a row and return its slot, for the caller to fill in."""
+        slot = self._next
+        self.timestamps[slot] = timestamp
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+        if self._unsaved < self.capacity:
+            self._unsaved += 1
+        return slot
+
+    def take_unsaved(self):
+        """Return the slots of the rows added since the last call, as contiguous runs."""
+        segments = list(self.segments(self._count - self._unsaved, self._count))
+        self._unsaved = 0
+        return segments
+
+    def segments(self, start, end):
+        """Yield the (first, last) slots covering rows start to end, as contiguous runs."""
+        if start >= end:
+            return
+        first = self.slot(start)
+        last = self.slot(end - 1) + 1
+        if first < last:
+            yield first, last
+        else:
+            yield first, self.capacity
+            yield 0, last
+
+
+def tier_capacity(step, retention):
+    return max(int(retention // step), 1)
+
+
+class Tier:
+    """
+    Rolls samples up into buckets of `step` seconds, keeping the min, average
+    and max of every metric for as many buckets as fit in `retention`.
+    """
+
+    def __init__(self, step, retention, metric_count, storage=None) -> None:
+        self.step = step
+        self.ring = SeriesRing(tier_capacity(step, retention), metric_count, storage)
+        self._metric_count = metric_count
+        self._bucket = None
+        self._count = array("I", [0]) * metric_count
+        self._sum = array("d", [0.0]) * metric_count
+        self._min = array("d", [0.0]) * metric_count
+        self._max = array("d", [0.0]) * metric_count
+
+    def add(self, timestamp, values):
+        bucket = timestamp - timestamp % self.step
+        if bucket != self._bucket:
+            if self._bucket is not None:
+                self._flush()
+            self._bucket = bucket
+            for m in range(self._metric_count):
+                self._count[m] = 0
+                self._sum[m] = 0.0
+
+        for m in range(self._metric_count):
+            value = values[m]
+            if value != value:
+                # NaN: the sensor had no reading
+                continue
+            if self._count[m] == 0:
+                self._min[m] = value
+                self._max[m] = value
+            else:
+                if value < self._min[m]:
+                    self._min[m] = value
+                if value > self._max[m]:
+                    self._max[m] = value
+            self._count[m] += 1
+            self._sum[m] += value
+
+    def _flush(self):
+        ring = self.ring
+        slot = ring.append(self._bucket)
+        minimum, average, maximum = ring.columns["min"], ring.columns["avg"], ring.columns["max"]
+        for m in range(self._metric_count):
+            index = m * ring.capacity + slot
+            count = self._count[m]
+            if count:
+                minimum[index] = self._min[m]
+                average[index] = self._sum[m] / count
+                maximum[index] = self._max[m]
+            else:
+                minimum[index] = average[index] = maximum[index] = NAN
+
+    def settled(self, end_time):
+        """Whether new samples can no longer change what's before end_time."""
+        return self._bucket is not None and end_time <= self._bucket
+
+    def covers(self, timestamp):
+        """Whether we still have everything recorded since timestamp."""
+        return not self.ring.full or self.ring[0] <= timestamp
+
+    def current(self, metric):
+        """The bucket still being filled, as (timestamp, min, avg, max), or None."""
+        if self._bucket is None:
+            return None
+        count = self._count[metric]
+        if count == 0:
+            return (self._bucket, NAN, NAN, NAN)
+        return (self._bucket, self._min[metric], self._sum[metric] / count, self._max[metric])
+
+    def slices(self, metric, start_time, end_time):
+        """
+        Return the buckets in [start_time, end_time) as a list of runs, each a
+        (timestamps, { field: values }) pair of slices of the ring's storage.
+        """
+        ring = self.ring
+        start = bisect.bisect_left(ring, start_time - self.step + 1e-9, 0, len(ring))
+        end = bisect.bisect_left(ring, end_time, 0, len(ring))
+
+        runs = []
+        base = metric * ring.capacity
+        for first, last in ring.segments(start, end):
+            runs.append((ring.timestamps[first:last], { field: ring.columns[field][base + first:base + last]
+                for field in FIELDS }))
+
+        current = self.current(metric)
+        if current is not None and start_time - self.step < current[0] < end_time:
+            runs.append((array("d", current[:1]), { field: array("f", [value])
+                for field, value in zip(FIELDS, current[1:]) }))
+        return runs
+
+    def chunks(self, metrics, start_time, end_time, size):
+        """
+        Yield the rows that started in [start_time, end_time) in chunks of at
+        most `size` rows, each a (timestamps, columns) pair of lists where
+        columns[field][i] holds the values of metrics[i]. Chunks are copies,
+        and each is looked up by time, so the ring may move on in between.
+        The bucket still being filled isn't included.
+        """
+        ring = self.ring
+        start = bisect.bisect_left(ring, start_time, 0, len(ring))
+        while True:
+            end = min(bisect.bisect_left(ring, end_time, 0, len(ring)), start + size)
+            if start >= end:
+                return
+
+            timestamps = []
+            columns = { field: [[] for _ in metrics] for field in FIELDS }
+            for first, last in ring.segments(start, end):
+                timestamps.extend(ring.timestamps[first:last])
+                for field in FIELDS:
+                    for values, metric in zip(columns[field], metrics):
+                        base = metric * ring.capacity
+                        values.extend(ring.columns[field][base + first:base + last])
+            yield timestamps, columns
+
+            start = bisect.bisect_right(ring, timestamps[-1], 0, len(ring))
+
+    def read(self, metric, start_time, end_time):
+        """Return timestamps and min/avg/max lists for the buckets in [start_time, end_time)."""
+        timestamps = []
+        columns = { field: [] for field in FIELDS }
+        for run_timestamps, run_columns in self.slices(metric, start_time, end_time):
+            timestamps.extend(run_timestamps)
+            for field in FIELDS:
+                columns[field].extend(run_columns[field])
+        return timestamps, columns
+
+
+HISTORY_MAGIC = b"PYBMCHST"
+HISTORY_VERSION = 1
+# Magic, version, payload length and CRC-32 of the payload
+HEADER_FORMAT = "<8sIII"
+
+def align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class HistoryFile:
+    """
+    Preallocated file holding the rings of every tier, mapped into memory.
+    The rings live in a private buffer loaded from the file at startup, so
+    samples never dirty the mapping; flush() copies the rows added since the
+    previous one into it and syncs them, so the SD card is only written to
+    every `flush-interval` seconds.
+
+    The header holds the schema (metrics and tiers), the cursor of each ring
+    and a checksum. It's only rewritten by flush(), after the data has been
+    synced, so after a power loss the header still describes data that made
+    it to disk. Rows synced before a header update that didn't make it are
+    picked up again when they're in order (see SeriesRing.restore()).
+    """
+
+    def __init__(self, path, schema, capacities, metric_count) -> None:
+        self._schema = schema
+        # Leave room (in whole pages) for the header with the longest cursors there can be
+        longest = self._pack_header([[capacity, capacity] for capacity in capacities])
+        self._header_size = align(len(longest), mmap.PAGESIZE)
+
+        layout = []
+        offset = self._header_size
+        for capacity in capacities:
+            timestamps = (offset, capacity * 8)
+            offset = align(offset + capacity * 8)
+            columns = {}
+            for field in FIELDS:
+                columns[field] = (offset, capacity * metric_count * 4)
+                offset = align(offset + capacity * metric_count * 4)
+            layout.append((timestamps, columns))
+        size = offset
+        self._layout = layout
+        self._metric_count = metric_count
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            valid = os.fstat(fd).st_size == size
+            if valid:
+                self._map = mmap.mmap(fd, size)
+                self.cursors = self._read_header()
+                valid = self.cursors is not None
+                if not valid:
+                    self._map.close()
+            if not valid:
+                logger.log(f"Creating history file {path} ({size // 1024} KiB)")
+                # Start from a zero-filled file, so old rows can't be mistaken for new ones
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+                self.cursors = None
+        finally:
+            os.close(fd)
+
+        # Offsets in the buffer are file offsets less the header
+        self._buffer = bytearray(self._map[self._header_size:])
+        view = memoryview(self._buffer)
+        self.storage = []
+        start = self._header_size
+        for (offset, length), columns in layout:
+            timestamps = view[offset - start:offset - start + length].cast("d")
+            columns = { field: view[offset - start:offset - start + length].cast("f")
+                for field, (offset, length) in columns.items() }
+            self.storage.append((timestamps, columns))
+
+    def _read_header(self):
+        magic, version, length, checksum = struct.unpack_from(HEADER_FORMAT, self._map)
+        if magic != HISTORY_MAGIC or version != HISTORY_VERSION:
+            return None
+        start = struct.calcsize(HEADER_FORMAT)
+        if start + length > self._header_size:
+            return None
+        payload = self._map[start:start + length]
+        if zlib.crc32(payload) != checksum:
+            logger.log("History file header is corrupt")
+            return None
+
+        header = json.loads(payload)
+        if header["schema"] != self._schema:
+            logger.log("History file was written with different settings")
+            return None
+        return header["cursors"]
+
+    def unsaved(self, rings):
+        """
+        Return the rows the rings added since the last call, as (file offset,
+        bytes) pairs for flush(). They're copies, so the rings can move on.
+        """
+        ranges = []
+        for ((timestamps_offset, _), columns), ring in zip(self._layout, rings):
+            for first, last in ring.take_unsaved():
+                ranges.append((timestamps_offset + first * 8, timestamps_offset + last * 8))
+                for offset, _ in columns.values():
+                    for m in range(self._metric_count):
+                        base = offset + m * ring.capacity * 4
+                        ranges.append((base + first * 4, base + last * 4))
+        return [(start, bytes(self._buffer[start - self._header_size:end - self._header_size]))
+            for start, end in ranges]
+
+    def flush(self, writes, cursors):
+        """Write and sync the rows, then record the cursors. Safe to call from another thread."""
+        header = self._pack_header(cursors)
+        if len(header) > self._header_size:
+            # Would run into the first ring
+            raise RuntimeError(f"History file header too large ({len(header)} bytes)")
+
+        for offset, data in writes:
+            self._map[offset:offset + len(data)] = data
+        self._map.flush()
+        self._map[:len(header)] = header
+        self._map.flush(0, self._header_size)
+
+    def _pack_header(self, cursors):
+        payload = json.dumps({
+            "schema": self._schema,
+            "cursors": cursors,
+        }).encode()
+        return struct.pack(HEADER_FORMAT, HISTORY_MAGIC, HISTORY_VERSION,
+            len(payload), zlib.crc32(payload)) + payload
+
+
+def metric_getters(snapshot):
+    getters = {}
+    for i, fan in enumerate(snapshot.case_fans):
+        getters[f"fans.{fan.id}.rpm"] = lambda s, i=i: s.case_fans[i].rpm
+        getters[f"fans.{fan.id}.dutyCycle"] = lambda s, i=i: s.case_fans[i].duty_cycle
+    getters["temp.temperatureC"] = lambda s: s.temp.temperature_c
+    getters["temp.humidity"] = lambda s: s.temp.humidity
+    getters["psu.powerState"] = lambda s: s.psu.power_state
+    getters["psu.powerOk"] = lambda s: s.psu.power_ok
+    return getters
+
+
+class History:
+    """
+    History of every sensor reading, fed with the sampler's snapshots.
+    Snapshots are sampled every `interval` seconds into a short raw tier and
+    rolled up into coarser min/avg/max tiers. Memory use is fixed at startup
+    by the configured retention of each tier.
+
+    When a file is configured, the tiers are saved to it and survive
+    restarts. New rows are only written out every `flush-interval` seconds,
+    as one batch.
+    """
+
+    def __init__(self, snapshot) -> None:
+        swconfig = load_config(CONFIG_FILE)
+        settings = dict(DEFAULT_SETTINGS)
+        settings.update(swconfig["pybmc"].get("history", {}))
+        if FILE_VARIABLE in os.environ:
+            settings["file"] = os.environ[FILE_VARIABLE]
+        data_dir = swconfig["pybmc"].get("data-dir", DEFAULT_DATA_DIR)
+
+        getters = metric_getters(snapshot)
+        self.metrics = list(getters)
+        self._index = { name: i for i, name in enumerate(self.metrics) }
+        self._getters = list(getters.values())
+        self._values = array("d", [NAN]) * len(self.metrics)
+
+        self._interval = settings["interval"]
+        self._last_time = 0.0
+        # Bumped with every recorded sample, so derived data can tell it's stale
+        self.generation = 0
+        tiers = [(self._interval, settings["raw-retention"])]
+        tiers += [(tier["step"], tier["retention"]) for tier in settings["tiers"]]
+
+        self._file = None
+        self._flush_interval = settings["flush-interval"]
+        self._last_flush = 0.0
+        self._flushing = False
+        if settings["file"]:
+            schema = {
+                "metrics": self.metrics,
+                "tiers": [[step, tier_capacity(step, retention)] for step, retention in tiers],
+            }
+            capacities = [capacity for _, capacity in schema["tiers"]]
+            # Relative to the data directory (an absolute path stays as is)
+            path = os.path.join(data_dir, settings["file"])
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self._file = HistoryFile(path, schema, capacities, len(self.metrics))
+            except OSError as e:
+                logger.log(f"Can't use history file {path}, keeping history in memory: {e!r}")
+
+        self.tiers = []
+        for i, (step, retention) in enumerate(tiers):
+            storage = self._file.storage[i] if self._file is not None else None
+            self.tiers.append(Tier(step, retention, len(self.metrics), storage))
+
+        if self._file is not None and self._file.cursors is not None:
+            for tier, cursor in zip(self.tiers, self._file.cursors):
+                tier.ring.restore(cursor)
+            raw = self.tiers[0].ring
+            if len(raw):
+                self._last_time = raw[len(raw) - 1]
+            logger.log(f"Restored {len(raw)} raw samples of history")
+
+        logger.log(f"History of {len(self.metrics)} metrics uses {self.nbytes // 1024} KiB")
+
+    @property
+    def nbytes(self):
+        return sum(tier.ring.nbytes for tier in self.tiers)
+
+    def record(self, snapshot):
+        timestamp = snapshot.timestamp
+        timestamp -= timestamp % self._interval
+        # Also skips samples while the clock is behind what we recorded
+        # (e.g. after it was set back), so the tiers stay in order
+        if timestamp <= self._last_time:
+            return
+        self._last_time = timestamp
+        self.generation += 1
+
+        values = self._values
+        for m, getter in enumerate(self._getters):
+            value = getter(snapshot)
+            values[m] = NAN if value is None else value
+        for tier in self.tiers:
+            tier.add(timestamp, values)
+
+        if self._file is not None and not self._flushing and \
+                timestamp - self._last_flush >= self._flush_interval:
+            self._last_flush = timestamp
+            self._flushing = True
+            # Syncing to the SD card can take a while, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self._file.flush, self._unsaved(), self._cursors())
+            future.add_done_callback(self._on_flushed)
+
+    def _unsaved(self):
+        return self._file.unsaved([tier.ring for tier in self.tiers])
+
+    def _cursors(self):
+        return [tier.ring.cursor for tier in self.tiers]
+
+    def _on_flushed(self, future):
+        self._flushing = False
+        if future.exception() is not None:
+            logger.log(f"Error flushing history: {future.exception()!r}")
+
+    def flush(self):
+        """Write the history file out now (on shutdown)."""
+        if self._file is not None:
+            self._file.flush(self._unsaved(), self._cursors())
+
+    def select_tier(self, start_time, step=None):
+        """
+        Pick the coarsest tier that's no coarser than step and still covers
+        start_time (or the finest covering one when there's no step).
+        """
+        covering = [tier for tier in self.tiers if tier.covers(start_time)]
+        if not covering:
+            # Nothing goes back that far; the longest history is the best we have
+            return self.tiers[-1]
+        if step is None:
+            return covering[0]
+
+        fitting = [tier for tier in covering if tier.step <= step]
+        return fitting[-1] if fitting else covering[0]
+
+    def index(self, metric):
+        return self._index[metric]
+
+    def query(self, metric, start_time, end_time, step=None):
+        if metric not in self._index:
+            raise KeyError(metric)
+
+        tier = self.select_tier(start_time, step)
+        timestamps, columns = tier.read(self._index[metric], start_time, end_time)
+        result = {
+            "metric": metric,
+            "from": start_time,
+            "to": end_time,
+            "step": tier.step,
+            "timestamps": timestamps,
+        }
+        for field in FIELDS:
+            result[field] = [None if math.isnan(value) else value for value in columns[field]]
+        return result
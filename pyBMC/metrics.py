@@ -0,0 +1,157 @@
+#
+# Prometheus metrics, in the text exposition format
+#
+
+import bisect
+from array import array
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Bits of the Pi's get_throttled value
+THROTTLING_FLAGS = (
+    (0, "under_voltage"),
+    (1, "arm_frequency_capped"),
+    (2, "throttled"),
+    (3, "soft_temperature_limit"),
+    (16, "under_voltage_occurred"),
+    (17, "arm_frequency_capped_occurred"),
+    (18, "throttled_occurred"),
+    (19, "soft_temperature_limit_occurred"),
+)
+
+DHT22_ERRORS = ("bad_checksum", "short_message", "missing_message", "sensor_resets")
+
+# The sampler refreshes the Pi stats every few seconds; anything older than
+# this means collecting them failed, and they're left out rather than exported
+PI_STATS_MAX_AGE = 30
+
+def label(value):
+    """Escape a label value, for use in a %-format template."""
+    value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return value.replace("%", "%%")
+
+def sample(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self._buckets = buckets
+        # One more for what doesn't fit any bucket (+Inf)
+        self._counts = array("Q", [0]) * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def render(self, name, labels, lines):
+        cumulative = 0
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self._counts[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self._sum!r}")
+        lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+
+class RequestLatency:
+    """Latency histograms of the requests pyBMC served, by transport and handler."""
+
+    def __init__(self) -> None:
+        self._histograms = {}
+
+    def observe(self, transport, handler, seconds):
+        key = (transport, handler)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            self._histograms[key] = histogram
+        histogram.observe(seconds)
+
+    def render(self, lines):
+        name = "pybmc_request_duration_seconds"
+        lines.append(f"# HELP {name} Time taken to serve requests.")
+        lines.append(f"# TYPE {name} histogram")
+        for (transport, handler), histogram in sorted(self._histograms.items()):
+            labels = f'transport="{transport}",handler="{handler}"'
+            histogram.render(name, labels, lines)
+
+request_latency = RequestLatency()
+
+
+class SnapshotMetrics:
+    """
+    Renders the metrics of a snapshot. The set of fans doesn't change at
+    runtime, so the text is laid out once as a %-format template and a
+    scrape only fills in the values.
+    """
+
+    def __init__(self, snapshot) -> None:
+        lines = []
+
+        def gauge(name, help, series):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels in series:
+                lines.append(f"{name}{{{labels}}} %s" if labels else f"{name} %s")
+
+        def counter(name, help, series):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for labels in series:
+                lines.append(f"{name}{{{labels}}} %s")
+
+        fans = [f'fan="{label(fan.name)}",id="{fan.id}"' for fan in snapshot.case_fans]
+        sensor = f'sensor="{label(snapshot.temp.name)}"'
+        gauge("pybmc_fan_rpm", "Fan speed, in revolutions per minute.", fans)
+        gauge("pybmc_fan_duty_cycle", "Fan PWM duty cycle, in percent.", fans)
+        gauge("pybmc_temperature_celsius", "Case temperature.", [sensor])
+        gauge("pybmc_humidity_percent", "Case relative humidity.", [sensor])
+        counter("pybmc_dht22_errors_total", "Failed DHT22 readings, by kind of error.",
+            [f'{sensor},error="{error}"' for error in DHT22_ERRORS])
+        gauge("pybmc_psu_power_state", "Whether the PSU was told to power on.", [None])
+        gauge("pybmc_psu_power_ok", "Whether the PSU reports power ok.", [None])
+        gauge("pybmc_snapshot_timestamp_seconds", "When the readings were taken.", [None])
+        self._template = "\n".join(lines) + "\n"
+
+    def render(self, snapshot, system_stats):
+        """
+        Render the metrics of snapshot plus the Pi stats in system_stats. Stats
+        missing from system_stats (stale or unavailable) get no sample.
+        """
+        values = []
+        values.extend(sample(fan.rpm) for fan in snapshot.case_fans)
+        values.extend(sample(fan.duty_cycle) for fan in snapshot.case_fans)
+        values.append(sample(snapshot.temp.temperature_c))
+        values.append(sample(snapshot.temp.humidity))
+        values.extend(snapshot.temp.errors)
+        values.append(sample(snapshot.psu.power_state))
+        values.append(sample(snapshot.psu.power_ok))
+        values.append(sample(snapshot.timestamp))
+
+        lines = [
+            "# HELP pybmc_pi_cpu_temperature_celsius Raspberry Pi CPU temperature.",
+            "# TYPE pybmc_pi_cpu_temperature_celsius gauge",
+        ]
+        if "cpuTemp" in system_stats:
+            lines.append(f"pybmc_pi_cpu_temperature_celsius {sample(system_stats['cpuTemp'])}")
+        lines.append("# HELP pybmc_pi_throttled Raspberry Pi throttling flags (get_throttled).")
+        lines.append("# TYPE pybmc_pi_throttled gauge")
+        if "throttled" in system_stats:
+            throttled = system_stats["throttled"]
+            for bit, flag in THROTTLING_FLAGS:
+                lines.append(f'pybmc_pi_throttled{{flag="{flag}"}} {(throttled >> bit) & 1}')
+        return self._template % tuple(values) + "\n".join(lines) + "\n"
+
+
+def render(snapshot_metrics, snapshot, system_stats):
+    lines = []
+    request_latency.render(lines)
+    return snapshot_metrics.render(snapshot, system_stats) + "\n".join(lines) + "\n"
@@ -1,93 +1,290 @@
 
+import asyncio
+import fcntl
+import os
 import subprocess
 import re
+import struct
+from array import array
 from . import logger
+from .cache import SingleFlight, TtlCache
 
-def _run_command(cmd):
-    output = subprocess.check_output(cmd, stderr = subprocess.PIPE).decode("utf-8")
-    return output
+# Root of the filesystem the stats are read from. Pointing it at a directory of
+# fixture files (e.g. extra/sysroot-rpi4) lets this run on a machine that isn't a Pi.
+SYSTEM_ROOT = os.environ.get("PYBMC_SYSTEM_ROOT", "/")
 
-def _process_commands(commands):
-    results = { }
-    for cmd in commands:
-        # logger.log(f"Command: {cmd['cmd']}")
-        output = _run_command(cmd["cmd"])
-        # logger.log(f"Output: {output}")
-        for line in output.splitlines():
-            # logger.log(f"Line: {line}")
-            match = cmd["re"].search(line)
-            if match:
-                value = match.group(1)
-                # logger.log(f"Value: {value}")
-                if "converter" in cmd and cmd["converter"]:
-                    value = cmd["converter"](value)
-                    # logger.log(f"Converted value: {value}")
-                results[cmd["name"]] = value
-                break
+def _path(path):
+    return os.path.join(SYSTEM_ROOT, path.lstrip("/"))
+
+def _read_file(path):
+    with open(_path(path), "r") as f:
+        return f.read()
+
+def _search_file(path, regex):
+    match = regex.search(_read_file(path))
+    if not match:
+        raise LookupError(f"{regex.pattern} not found in {path}")
+    return match.group(1)
+
+#
+# VideoCore mailbox property interface (what vcgencmd uses under the covers)
+#
+
+VCIO_DEVICE = "/dev/vcio"
+# _IOWR(100, 0, char *)
+IOCTL_MBOX_PROPERTY = 0xC0000000 | (struct.calcsize("P") << 16) | (100 << 8)
+MBOX_REQUEST_SUCCESS = 0x80000000
+
+TAG_GET_ARM_MEMORY = 0x00010005
+TAG_GET_VC_MEMORY = 0x00010006
+TAG_GET_VOLTAGE = 0x00030003
+TAG_GET_TEMPERATURE = 0x00030006
+TAG_GET_THROTTLED = 0x00030046
+
+VOLTAGE_ID_CORE = 1
+
+def _mailbox_property(tag, args=(), response_words=1):
+    words = max(len(args), response_words)
+    # Buffer size, request code, tag, value buffer size, tag request code, values, end tag
+    message = array("I", [0, 0, tag, words * 4, 0] + list(args) + [0] * (words - len(args)) + [0])
+    message[0] = len(message) * 4
+
+    fd = os.open(_path(VCIO_DEVICE), os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, IOCTL_MBOX_PROPERTY, message, True)
+    finally:
+        os.close(fd)
+
+    if message[1] != MBOX_REQUEST_SUCCESS:
+        raise OSError(f"mailbox request for tag {tag:#x} failed")
+    return message[5:5 + response_words]
+
+#
+# In-process readers, one per field. They raise (OSError, ValueError or
+# LookupError) when the data isn't available, in which case we fall back to
+# running the field's command.
+#
+
+CPUINFO_MODEL_RE = re.compile(r"Model\s+:\s(.+)")
+CPUINFO_REVISION_RE = re.compile(r"Revision\s+:\s([0-9a-fA-F]+)")
+
+def _read_model():
+    return _search_file("/proc/cpuinfo", CPUINFO_MODEL_RE)
+
+def _read_total_mem():
+    # New style revision codes encode the memory size in bits 20-22
+    revision = int(_search_file("/proc/cpuinfo", CPUINFO_REVISION_RE), 16)
+    if not revision & (1 << 23):
+        raise LookupError("old style revision code")
+    return 256 << ((revision >> 20) & 7)
+
+def _read_cpu_mem():
+    _, size = _mailbox_property(TAG_GET_ARM_MEMORY, response_words=2)
+    return size // (1024 * 1024)
+
+def _read_gpu_mem():
+    _, size = _mailbox_property(TAG_GET_VC_MEMORY, response_words=2)
+    return size // (1024 * 1024)
+
+def _read_cpu_temp():
+    try:
+        return int(_read_file("/sys/class/thermal/thermal_zone0/temp")) / 1000
+    except OSError:
+        _, temp = _mailbox_property(TAG_GET_TEMPERATURE, [0], response_words=2)
+        return temp / 1000
+
+def _read_throttled():
+    try:
+        return _mailbox_property(TAG_GET_THROTTLED, [0])[0]
+    except OSError:
+        return int(_read_file("/sys/devices/platform/soc/soc:firmware/get_throttled"), 16)
 
+def _read_volts():
+    _, microvolts = _mailbox_property(TAG_GET_VOLTAGE, [VOLTAGE_ID_CORE], response_words=2)
+    return microvolts / 1000000
+
+def _read_uptime():
+    return _read_file("/proc/uptime").split()[0]
+
+#
+# Fallback: run the command and parse its output
+#
+
+# How long (in seconds) a field may take before we give up on it
+DEFAULT_TIMEOUT = 2
+
+class CommandError(RuntimeError):
+    pass
+
+async def _run_command(cmd, timeout):
+    process = await asyncio.create_subprocess_exec(*cmd,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # Timed out, or our caller was cancelled: don't leave the process behind
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise CommandError(f"{cmd[0]} exited with {process.returncode}")
+    return output.decode("utf-8")
+
+def _parse_output(cmd, output):
+    for line in output.splitlines():
+        match = cmd["re"].search(line)
+        if match:
+            value = match.group(1)
+            if "converter" in cmd and cmd["converter"]:
+                value = cmd["converter"](value)
+            return value
+    raise LookupError(f"{cmd['re'].pattern} not found in the output of {cmd['cmd'][0]}")
+
+async def _collect_field(field):
+    loop = asyncio.get_running_loop()
+    timeout = field.get("timeout", DEFAULT_TIMEOUT)
+    reader = field.get("reader")
+    if reader:
+        try:
+            # Readers are quick, but the mailbox ioctl still blocks
+            return await asyncio.wait_for(loop.run_in_executor(None, reader), timeout)
+        except (OSError, ValueError, LookupError, asyncio.TimeoutError):
+            pass
+
+    output = await _run_command(field["cmd"], timeout)
+    return _parse_output(field, output)
+
+async def _collect(fields):
+    # All fields are collected at once; one that fails or hangs is left out
+    # of the results without holding up the others.
+    values = await asyncio.gather(*(_collect_field(field) for field in fields),
+        return_exceptions=True)
+
+    results = { }
+    for field, value in zip(fields, values):
+        if isinstance(value, Exception):
+            logger.log(f"Unable to get {field['name']}: {value!r}")
+            continue
+        results[field["name"]] = value
     return results
 
-# Return static data (data we don't expect to change)
-def get_system_info():
-    commands = [
-        {
-            "name": "model",
-            "cmd": ["cat", "/proc/cpuinfo"],
-            "re": re.compile("Model\s+:\s(.+)"),
-        },
-        {
-            "name": "totalMem",
-            "cmd": ["vcgencmd", "get_config", "int"],
-            "re": re.compile("total_mem=(\d+)"),
-            "converter": lambda x: int(x),
-        },
-        {
-            "name": "cpuMem",
-            "cmd": ["vcgencmd", "get_mem", "arm"],
-            "re": re.compile("arm=(\d+)M"),
-            "converter": lambda x: int(x),
-        },
-        {
-            "name": "gpuMem",
-            "cmd": ["vcgencmd", "get_mem", "gpu"],
-            "re": re.compile("gpu=(\d+)M"),
-            "converter": lambda x: int(x),
-        },
-    ]
+# Static data (data we don't expect to change)
+SYSTEM_INFO_FIELDS = [
+    {
+        "name": "model",
+        "reader": _read_model,
+        "cmd": ["cat", "/proc/cpuinfo"],
+        "re": re.compile("Model\s+:\s(.+)"),
+    },
+    {
+        "name": "totalMem",
+        "reader": _read_total_mem,
+        "cmd": ["vcgencmd", "get_config", "int"],
+        "re": re.compile("total_mem=(\d+)"),
+        "converter": lambda x: int(x),
+    },
+    {
+        "name": "cpuMem",
+        "reader": _read_cpu_mem,
+        "cmd": ["vcgencmd", "get_mem", "arm"],
+        "re": re.compile("arm=(\d+)M"),
+        "converter": lambda x: int(x),
+    },
+    {
+        "name": "gpuMem",
+        "reader": _read_gpu_mem,
+        "cmd": ["vcgencmd", "get_mem", "gpu"],
+        "re": re.compile("gpu=(\d+)M"),
+        "converter": lambda x: int(x),
+    },
+]
+
+# Data that changes; each field is cached for its "ttl" (in seconds)
+SYSTEM_STATS_FIELDS = [
+    {
+        "name": "cpuTemp",
+        "ttl": 1,
+        "reader": _read_cpu_temp,
+        "cmd": ["vcgencmd", "measure_temp"],
+        "re": re.compile("^temp=([\d\.]+)'C"),
+        "converter": lambda x: float(x),
+    },
+    {
+        "name": "throttled",
+        "ttl": 1,
+        "reader": _read_throttled,
+        "cmd": ["vcgencmd", "get_throttled"],
+        "re": re.compile("throttled=0x([0-9a-fA-F]+)"),
+        "converter": lambda x: int(x, 16),
+    },
+    {
+        "name": "volts",
+        "ttl": 5,
+        "reader": _read_volts,
+        "cmd": ["vcgencmd", "measure_volts"],
+        "re": re.compile("volt=([\d.]+)V"),
+        "converter": lambda x: float(x),
+    },
+    {
+        "name": "uptime",
+        "ttl": 1,
+        "reader": _read_uptime,
+        "cmd": ["cat", "/proc/uptime"],
+        "re": re.compile("^([\d.]+)"),
+    },
+    # TODO:
+    # - Memory usage: bar graph (green/red) for available/used?
+]
+
+# Marks fields we tried but couldn't get, so we don't retry them until they expire
+_UNAVAILABLE = object()
+
+_system_info = None
+_system_info_flight = SingleFlight()
+_system_stats = TtlCache()
+_system_stats_flight = SingleFlight()
+
+async def get_system_info():
+    # Collected once; only a restart will collect it again
+    global _system_info
+    if _system_info is None:
+        _system_info = await _system_info_flight.run(_collect, SYSTEM_INFO_FIELDS)
 
     return {
-        "systemInfo": _process_commands(commands)
+        "systemInfo": _system_info
     }
 
-def get_system_stats():
-    commands = [
-        {
-            "name": "cpuTemp",
-            "cmd": ["vcgencmd", "measure_temp"],
-            "re": re.compile("^temp=([\d\.]+)'C"),
-            "converter": lambda x: float(x),
-        },
-        {
-            "name": "throttled",
-            "cmd": ["vcgencmd", "get_throttled"],
-            "re": re.compile("throttled=0x([0-9a-fA-F]+)"),
-            "converter": lambda x: int(x, 16),
-        },
-        {
-            "name": "volts",
-            "cmd": ["vcgencmd", "measure_volts"],
-            "re": re.compile("volt=([\d.]+)V"),
-            "converter": lambda x: float(x),
-        },
-        {
-            "name": "uptime",
-            "cmd": ["cat", "/proc/uptime"],
-            "re": re.compile("^([\d.]+)"),
-        },
-        # TODO:
-        # - Memory usage: bar graph (green/red) for available/used?
-    ]
+async def _refresh_system_stats():
+    expired = set(_system_stats.expired(field["name"] for field in SYSTEM_STATS_FIELDS))
+    fields = [field for field in SYSTEM_STATS_FIELDS if field["name"] in expired]
+    results = await _collect(fields)
+    for field in fields:
+        _system_stats.set(field["name"], results.get(field["name"], _UNAVAILABLE), field["ttl"])
+
+async def get_system_stats():
+    names = [field["name"] for field in SYSTEM_STATS_FIELDS]
+    if _system_stats.expired(names):
+        # However many clients ask, only one collection runs at a time
+        await _system_stats_flight.run(_refresh_system_stats)
 
     return {
-        "systemStats": _process_commands(commands)
+        "systemStats": peek_system_stats()
     }
+
+def peek_system_stats(max_age=None):
+    """
+    Return the stats collected last, without collecting anything. With
+    max_age, stats collected more than max_age seconds ago are left out.
+    """
+    stats = { }
+    for field in SYSTEM_STATS_FIELDS:
+        name = field["name"]
+        value = _system_stats.peek(name, _UNAVAILABLE)
+        if value is _UNAVAILABLE or (max_age is not None and _system_stats.age(name) > max_age):
+            continue
+        stats[name] = value
+    return stats
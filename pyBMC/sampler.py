@@ -0,0 +1,156 @@
+import asyncio
+import time
+from collections import namedtuple
+from . import logger, rpi
+from .sensors import load_config, CONFIG_FILE
+
+FanState = namedtuple("FanState", ["id", "name", "rpm", "duty_cycle"])
+TempState = namedtuple("TempState", ["name", "temperature_c", "humidity", "errors"])
+PsuState = namedtuple("PsuState", ["power_state", "power_ok"])
+Snapshot = namedtuple("Snapshot", ["seq", "timestamp", "case_fans", "temp", "psu"])
+
+# Events a slow subscriber can fall behind by before the oldest are dropped
+EVENT_QUEUE_SIZE = 64
+
+DEFAULT_INTERVALS = {
+    "fans": 0.25,
+    "temp": 3,
+    "psu": 0.25,
+    "system": 5,
+}
+
+class Sampler:
+    """
+    Owns all hardware reads. Each sensor group is sampled on its own schedule
+    and, after every sample, an immutable snapshot of the whole system is
+    published. Request handlers only ever look at the latest snapshot.
+    Snapshots are numbered by seq, which only changes along with the readings.
+
+    Besides snapshots, the sampler relays events (power ok transitions,
+    changes made through the API) to whoever subscribed to them.
+    """
+
+    def __init__(self, sensors) -> None:
+        self._sensors = sensors
+        self._tasks = []
+        self._snapshot = None
+        # Sequence numbers start from the current time in ms, so they keep
+        # increasing across restarts and clients can't confuse two snapshots
+        self._seq = int(time.time() * 1000)
+        self._updated = asyncio.Event()
+        self._event_queues = set()
+        self._listeners = []
+
+        swconfig = load_config(CONFIG_FILE)
+        self._intervals = dict(DEFAULT_INTERVALS)
+        self._intervals.update(swconfig["pybmc"].get("sampler", {}).get("intervals", {}))
+
+        self._readers = {
+            # RPM is computed from the tach callbacks, so there's nothing to read
+            "fans": None,
+            "temp": sensors.read_temp_state,
+            "psu": sensors.update_psu_state,
+            # Keeps the Pi's stats (CPU temperature, throttling) current for /metrics
+            "system": rpi.get_system_stats,
+        }
+
+        self.publish()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._sensors.psu.power_ok.add_listener(
+            lambda level, tick: loop.call_soon_threadsafe(self._on_power_ok_edge, level, tick))
+
+        for name, interval in self._intervals.items():
+            logger.log(f"Sampling {name} every {interval}s")
+            task = asyncio.create_task(self._run_schedule(name, self._readers[name], interval))
+            self._tasks.append(task)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def add_listener(self, listener):
+        """Have listener called with every new snapshot."""
+        self._listeners.append(listener)
+
+    def publish(self):
+        """Build a new snapshot from the sensors' cached values. No hardware is touched."""
+        sensors = self._sensors
+        case_fans = tuple(FanState(fan.id, fan.name, fan.rpm, fan.duty_cycle)
+            for fan in sensors.case_fans)
+        temp = TempState(sensors.temp.name, sensors.temp.temperature_c, sensors.temp.humidity,
+            sensors.temp.errors)
+        psu = PsuState(sensors.psu.power_switch.state, sensors.psu.power_ok.state)
+
+        # seq only moves when a reading changed, so it can tell clients
+        # whether what they have is still current
+        previous = self._snapshot
+        changed = previous is None or (case_fans, temp, psu) != previous[2:]
+        if changed:
+            self._seq += 1
+        self._snapshot = Snapshot(self._seq, time.time(), case_fans, temp, psu)
+
+        for listener in self._listeners:
+            listener(self._snapshot)
+
+        if changed:
+            # Wake up everybody waiting for a new snapshot
+            self._updated.set()
+            self._updated = asyncio.Event()
+        return self._snapshot
+
+    async def wait_for_update(self, seq):
+        """Return the first snapshot with a seq greater than seq, waiting for it if needed."""
+        while self._snapshot.seq <= seq:
+            await self._updated.wait()
+        return self._snapshot
+
+    def subscribe_events(self):
+        queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self._event_queues.add(queue)
+        return queue
+
+    def unsubscribe_events(self, queue):
+        self._event_queues.discard(queue)
+
+    def post_event(self, event_type, **data):
+        event = { "type": event_type, "timestamp": time.time() }
+        event.update(data)
+        for queue in self._event_queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _on_power_ok_edge(self, level, tick):
+        self.post_event("powerOk", powerOk=level, tick=tick)
+        self.publish()
+
+    async def _run_schedule(self, name, reader, interval):
+        loop = asyncio.get_running_loop()
+        next_run = loop.time()
+        while True:
+            if reader is not None:
+                try:
+                    if asyncio.iscoroutinefunction(reader):
+                        await reader()
+                    else:
+                        # Blocking hardware reads are kept off the event loop
+                        await loop.run_in_executor(None, reader)
+                except Exception as e:
+                    logger.log(f"Error sampling {name}: {e!r}")
+            self.publish()
+
+            next_run += interval
+            delay = next_run - loop.time()
+            if delay < 0:
+                # We fell behind (slow read); don't try to catch up
+                next_run = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
@@ -6,69 +6,107 @@
 # (https://blog.driftking.tw/en/2019/11/Using-Raspberry-Pi-to-Control-a-PWM-Fan-and-Monitor-its-Speed/)
 #
 
+import asyncio
+import time
+from collections import deque, namedtuple
 import pigpio
 import yaml
-from . import DHT22, logger
+from . import DHT22, hardware, logger, tach
 
 CONFIG_FILE = "pybmc.conf"
 HARDWARE_CONFIG_FILE = "pybmc.hardware.conf"
 
 class RpmPin:
-    def __init__(self, pi, pin, weighting=0.0, pulses_per_rev=1) -> None:
+    def __init__(self, pi, pin, estimator, pulses_per_rev=1, stall_timeout=1000,
+            window=tach.DEFAULT_WINDOW, use_callback=True) -> None:
         self._pi = pi
         self._pin = pin
         self._pulses_per_rev = pulses_per_rev
         self._high_tick = None
-        self._period = None
+        # When (time.monotonic()) the latest edge reached us
+        self._edge_time = None
+        self._intervals = tach.IntervalRing(estimator.ring_size(window))
+        self._estimator = estimator
 
-        # Watchdog: 200ms
-        self._watchdog = 200
-
-        # Weighting is a number between 0 and 1 and indicates how much the old reading affects the
-        # new reading. It defaults to 0 which means the old reading has no effect. This may be used
-        # to smooth the data.
-        if weighting < 0.0:
-            weighting = 0.0
-        elif weighting > 0.99:
-            weighting = 0.99
-
-        self._old_value_weight = weighting
-        self._new_value_weight = 1.0 - weighting
+        # A fan with no pulses for stall_timeout ms is considered stopped. The
+        # watchdog makes sure we get to check even when no edges come in.
+        self._stall_timeout = stall_timeout * 1000
+        self._stalled = True
+        self._watchdog = min(200, stall_timeout)
 
         self._pi.set_mode(self._pin, pigpio.INPUT)
         self._pi.set_pull_up_down(self._pin, pigpio.PUD_UP)
-        self._callback = self._pi.callback(self._pin, pigpio.FALLING_EDGE, self.on_rpm_pin_falling_edge)
+        self._callback = None
+        if use_callback:
+            self.enable_callback()
         self._pi.set_watchdog(self._pin, self._watchdog)
 
+    @property
+    def pin(self):
+        return self._pin
+
+    def enable_callback(self):
+        # Edges are delivered one by one; not needed when a NotifyCapture feeds us
+        self._callback = self._pi.callback(self._pin, pigpio.FALLING_EDGE, self.on_rpm_pin_falling_edge)
+
     def on_rpm_pin_falling_edge(self, pin, level, tick):
         if level == 0: # Falling edge
             if self._high_tick is not None:
                 t = pigpio.tickDiff(self._high_tick, tick)
-                if self._period is not None:
-                    self._period = (self._period * self._old_value_weight) + (t * self._new_value_weight)
-                else:
-                    self._period = t
+                self._intervals.append(t)
+                self._estimator.update(t)
+                self._stalled = False
             self._high_tick = tick
+            self._edge_time = time.monotonic()
 
         elif level == 2: # Watchdog timeout
-            if self._period is not None:
-                if self._period < 2000000000:
-                    self._period += (self._watchdog * 1000)
+            if self._high_tick is None or pigpio.tickDiff(self._high_tick, tick) >= self._stall_timeout:
+                # Whatever we measured before the stall no longer applies
+                self.reset()
+
+    def add_edges(self, ticks):
+        """Record a batch of falling edges, given as their ticks in order."""
+        if len(ticks) == 0:
+            return
+
+        self._edge_time = time.monotonic()
+        if self._high_tick is None:
+            self._high_tick = int(ticks[0])
+            ticks = ticks[1:]
+            if len(ticks) == 0:
+                return
+
+        intervals = tach.tick_intervals(self._high_tick, ticks)
+        self._intervals.extend(intervals)
+        self._estimator.update_many(intervals)
+        self._high_tick = int(ticks[-1])
+        self._stalled = False
 
     def stop(self):
         self._pi.set_watchdog(self._pin, 0)
-        self._callback.cancel()
-        self._callback = None
+        if self._callback is not None:
+            self._callback.cancel()
+            self._callback = None
 
     def reset(self):
         self._high_tick = None
-        self._period = None
+        self._edge_time = None
+        self._intervals.clear()
+        self._estimator.reset()
+        self._stalled = True
+
+    @property
+    def stalled(self):
+        return self._stalled
 
     @property
     def rpm(self):
         rpm = 0.0
-        if self._period is not None:
-            rpm = 60000000.0 / (self._period * self._pulses_per_rev)
+        if not self._stalled:
+            age = (time.monotonic() - self._edge_time) * 1000000
+            period = self._estimator.period(self._intervals, age)
+            if period:
+                rpm = 60000000.0 / (period * self._pulses_per_rev)
         return rpm
 
 
@@ -96,13 +134,19 @@ class PwmPin:
 
 
 class Fan:
-    def __init__(self, id, name, pi, rpm_pin, pwm_pin, pwm_frequency, weighting=0.0, pulses_per_rev=1) -> None:
+    def __init__(self, id, name, pi, rpm_pin, pwm_pin, pwm_frequency, tach_settings,
+            use_callback=True) -> None:
         self.id = id
         self.name = name
 
         logger.log(f"Setting up GPIOs for fan {self.name}...")
-        logger.log(f"   RPM pin: {rpm_pin}")
-        self.rpm_pin = RpmPin(pi, rpm_pin, weighting, pulses_per_rev)
+        logger.log(f"   RPM pin: {rpm_pin} ({tach_settings.get('estimator', 'ewma')})")
+        self.rpm_pin = RpmPin(pi, rpm_pin,
+            tach.create_estimator(tach_settings),
+            tach_settings.get("pulses-per-revolution", 1),
+            tach_settings.get("stall-timeout", 1000),
+            tach_settings.get("window", tach.DEFAULT_WINDOW),
+            use_callback)
 
         logger.log(f"   PWM pin: {pwm_pin}")
         self.pwm_pin = PwmPin(pi, pwm_pin, pwm_frequency)
@@ -126,6 +170,8 @@ class Fan:
         self.pwm_pin.set_duty_cycle(speed)
 
 
+DHT22Errors = namedtuple("DHT22Errors", ["bad_checksum", "short_message", "missing_message", "sensor_resets"])
+
 class TempHumiditySensor:
     def __init__(self, name, pi, pin) -> None:
         self.name = name
@@ -148,6 +194,20 @@ class TempHumiditySensor:
         except RuntimeError:
             pass
 
+    async def read(self):
+        # The sampler sets the pace, but never read often enough to hang the DHT22
+        staleness = self._device.staleness()
+        if staleness != DHT22.INVALID_VALUE and staleness < DHT22.MIN_INTERVAL:
+            return
+
+        try:
+            reading = await self._device.acquire()
+            self._temp_c = reading.temperature
+            self._humidity = reading.humidity
+        except DHT22.DHT22Error:
+            # Failures are tracked by the device's error counters
+            pass
+
     def stop(self):
         self._device.cancel()
 
@@ -159,6 +219,36 @@ class TempHumiditySensor:
     def humidity(self):
         return self._humidity
 
+    @property
+    def errors(self):
+        device = self._device
+        return DHT22Errors(device.bad_checksum(), device.short_message(),
+            device.missing_message(), device.sensor_resets())
+
+
+class GpioBank:
+    """
+    Reads the levels of all bank 1 GPIOs (0-31) with a single round trip to
+    pigpiod and hands them to every input pin registered with it.
+    """
+
+    def __init__(self, pi) -> None:
+        self._pi = pi
+        self._pins = []
+
+    def register(self, pin):
+        self._pins.append(pin)
+
+    def update_state(self):
+        if not self._pins:
+            return
+
+        levels = self._pi.read_bank_1()
+        for pin in self._pins:
+            pin.update_from_bank(levels)
+
+
+Transition = namedtuple("Transition", ["level", "tick", "timestamp"])
 
 class PsuPin:
     def __init__(self, name, pi, pin, mode) -> None:
@@ -167,6 +257,9 @@ class PsuPin:
         self._pin = pin
         self._mode = mode
         self._state = 0
+        self._callback = None
+        self._transitions = None
+        self._listeners = []
 
         if self._mode == pigpio.INPUT:
             self._pi.set_mode(self._pin, pigpio.INPUT)
@@ -176,10 +269,56 @@ class PsuPin:
             self._pi.write(self._pin, 0)
 
     def update_state(self):
+        # Output pins report what we last wrote; no need to read them back
+        if self._mode == pigpio.INPUT:
+            self._state = self._pi.read(self._pin)
+
+    def update_from_bank(self, levels):
+        self._state = (levels >> self._pin) & 1
+
+    def track_edges(self, glitch_filter=0, history_size=64):
+        """
+        Keep the state of an input pin up to date from its edges instead of
+        polling it, remembering the last history_size transitions. A non-zero
+        glitch_filter (in microseconds) ignores levels that aren't steady for
+        at least that long.
+        """
+        if self._mode != pigpio.INPUT:
+            raise RuntimeError("edge tracking is only valid on an input pin")
+
+        self._transitions = deque(maxlen=history_size)
+        if glitch_filter:
+            self._pi.set_glitch_filter(self._pin, glitch_filter)
+        self._callback = self._pi.callback(self._pin, pigpio.EITHER_EDGE, self._on_edge)
         self._state = self._pi.read(self._pin)
 
+    def _on_edge(self, pin, level, tick):
+        if level == pigpio.TIMEOUT:
+            return
+        self._state = level
+        self._transitions.append(Transition(level, tick, time.time()))
+        for listener in self._listeners:
+            listener(level, tick)
+
+    def add_listener(self, listener):
+        """Call listener(level, tick) on every edge. Runs on pigpio's callback thread."""
+        self._listeners.append(listener)
+
+    @property
+    def tracking_edges(self):
+        return self._callback is not None
+
+    @property
+    def transitions(self):
+        if self._transitions is None:
+            return []
+        return list(self._transitions)
+
     def stop(self):
-        pass
+        if self._callback is not None:
+            self._callback.cancel()
+            self._callback = None
+            self._pi.set_glitch_filter(self._pin, 0)
 
     @property
     def state(self):
@@ -205,14 +344,77 @@ class PsuPin:
         self.write(new_state)
 
 
+class PowerTimeoutError(RuntimeError):
+    pass
+
+PowerOperation = namedtuple("PowerOperation", ["state", "start_tick", "loop", "future"])
+
 class Psu:
-    def __init__(self, pi, power_switch_pin, power_ok_pin) -> None:
+    def __init__(self, pi, power_switch_pin, power_ok_pin, bank=None, track_edges=True,
+            glitch_filter=0, history_size=64) -> None:
+        self._pi = pi
+        self._pending = None
         self._power_switch = PsuPin("ps_switch", pi, power_switch_pin, pigpio.OUTPUT)
         self._power_ok = PsuPin("ps_ok", pi, power_ok_pin, pigpio.INPUT)
 
+        # Power ok is either kept current by its edges (so short glitches are
+        # seen), or polled through the bank (if given) or directly.
+        self._bank = None
+        if track_edges:
+            self._power_ok.track_edges(glitch_filter, history_size)
+            self._power_ok.add_listener(self._on_power_ok_edge)
+        elif bank is not None:
+            self._bank = bank
+            bank.register(self._power_ok)
+
     def update_state(self):
-        self._power_switch.update_state()
-        self._power_ok.update_state()
+        if self._bank is None and not self._power_ok.tracking_edges:
+            self._power_ok.update_state()
+
+    async def set_power_state(self, state, timeout=None):
+        """
+        Switch the PSU on or off and wait until power ok follows. Returns the
+        time it took, in milliseconds, or raises PowerTimeoutError. Callers
+        asking for the same state while an operation is in flight share it.
+        """
+        if not self._power_ok.tracking_edges:
+            raise RuntimeError("power operations require power ok edge tracking")
+
+        state = 1 if state else 0
+        op = self._pending
+        if op is None or op.state != state or op.future.done():
+            if op is not None and not op.future.done():
+                # Superseded by an operation in the other direction
+                op.future.set_result(None)
+
+            if self._power_ok.state == state:
+                self._pending = None
+                self._power_switch.write(state)
+                return 0.0
+
+            # Register before writing so we can't miss the edge
+            loop = asyncio.get_running_loop()
+            op = PowerOperation(state, self._pi.get_current_tick(), loop, loop.create_future())
+            self._pending = op
+            self._power_switch.write(state)
+
+        try:
+            tick = await asyncio.wait_for(asyncio.shield(op.future), timeout)
+        except asyncio.TimeoutError:
+            raise PowerTimeoutError(f"power ok did not go to {state} within {timeout}s")
+        if tick is None:
+            raise RuntimeError("power operation was superseded")
+        return pigpio.tickDiff(op.start_tick, tick) / 1000.0
+
+    def _on_power_ok_edge(self, level, tick):
+        op = self._pending
+        if op is not None and op.state == level and not op.future.done():
+            op.loop.call_soon_threadsafe(self._complete, op.future, tick)
+
+    @staticmethod
+    def _complete(future, tick):
+        if not future.done():
+            future.set_result(tick)
 
     def stop(self):
         self._power_switch.stop()
@@ -234,18 +436,20 @@ def load_config(file_path):
 
 class Sensors:
     def __init__(self) -> None:
-        self._pi = pigpio.pi()
-
         hwconfig = load_config(HARDWARE_CONFIG_FILE)
+        swconfig = load_config(CONFIG_FILE)
+
+        self._pi = hardware.create_pi(swconfig, hwconfig)
+        self._gpio_bank = GpioBank(self._pi)
+
         fan_settings = hwconfig["pybmc"]["fans"]["settings"]
-        pulses_per_revolution = fan_settings["pulses-per-revolution"]
         pwm_frequency = fan_settings["pwm-frequency"]
-        weighting = fan_settings["weighting"]
+        notify_capture = fan_settings.get("capture", "callback") == "notify"
 
-        swconfig = load_config(CONFIG_FILE)
         fan_config = swconfig["pybmc"]["fans"]
         default_fan_speed = fan_config["default-speed"]
         self.sync_fans_speeds = fan_config["sync-speeds"]
+        self.power_ok_timeout = swconfig["pybmc"].get("psu", {}).get("power-ok-timeout", 5)
 
         self.case_fans = []
         fan_id = 0
@@ -253,11 +457,26 @@ class Sensors:
             name = fan_data["name"]
             rpm_pin = fan_data["rpm-pin"]
             pwm_pin = fan_data["pwm-pin"]
-            fan = Fan(fan_id, name, self._pi, rpm_pin, pwm_pin, weighting, pulses_per_revolution, pwm_frequency)
+            # Tach settings can be overridden per fan
+            tach_settings = dict(fan_settings)
+            tach_settings.update(fan_data)
+            fan = Fan(fan_id, name, self._pi, rpm_pin, pwm_pin, pwm_frequency, tach_settings,
+                use_callback=not notify_capture)
             fan.set_speed(default_fan_speed)
             self.case_fans.append(fan)
             fan_id += 1
 
+        self._tach_capture = None
+        if notify_capture:
+            rpm_pins = { fan.rpm_pin.pin: fan.rpm_pin for fan in self.case_fans }
+            try:
+                self._tach_capture = tach.NotifyCapture(self._pi, rpm_pins)
+                logger.log("Capturing tach edges through a notification pipe")
+            except (pigpio.error, OSError) as e:
+                logger.log(f"Notification capture unavailable ({e!r}), using callbacks")
+                for rpm_pin in rpm_pins.values():
+                    rpm_pin.enable_callback()
+
         # We only support a single temp/humidity sensor for now
         temp_data = hwconfig["pybmc"]["temp-sensors"]
         name = temp_data[0]["name"]
@@ -267,11 +486,20 @@ class Sensors:
         psu_data = hwconfig["pybmc"]["psu"]
         power_switch_pin = psu_data["power-switch-pin"]
         power_ok_pin = psu_data["power-ok-pin"]
-        self.psu = Psu(self._pi, power_switch_pin, power_ok_pin)
+        self.psu = Psu(self._pi, power_switch_pin, power_ok_pin, self._gpio_bank,
+            psu_data.get("track-power-ok-edges", True),
+            psu_data.get("power-ok-glitch-filter", 0),
+            psu_data.get("transition-history", 64))
+
+    @property
+    def pi(self):
+        return self._pi
 
     def stop(self):
         self.psu.stop()
         self.temp.stop()
+        if self._tach_capture is not None:
+            self._tach_capture.stop()
         for fan in self.case_fans:
             fan.stop()
         self._pi.stop()
@@ -283,7 +511,18 @@ class Sensors:
         self.stop()
 
     def update_state(self):
+        self.update_temp_state()
+        self.update_psu_state()
+
+    def update_temp_state(self):
         self.temp.update_state()
+
+    async def read_temp_state(self):
+        await self.temp.read()
+
+    def update_psu_state(self):
+        # One read of the whole bank covers every digital input we have
+        self._gpio_bank.update_state()
         self.psu.update_state()
 
         # If power is not on, we need to manually reset the state of the fans
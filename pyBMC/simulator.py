@@ -0,0 +1,378 @@
+#
+# Simulated pigpio backend
+#
+# Stands in for pigpio.pi() so pyBMC can run (and be load tested) on a machine
+# without a Raspberry Pi or pigpiod. It models the BMC board: fans produce tach
+# edges according to their PWM duty cycle, the DHT22 answers start pulses with
+# real bit streams and the PSU raises power ok some time after being switched.
+#
+
+import heapq
+import random
+import threading
+import time
+import pigpio
+from . import logger
+
+# Duty cycle (%) to RPM, roughly a Noctua NF-A14 industrialPPC-3000 PWM
+DEFAULT_FAN_CURVE = [[0, 0], [10, 600], [100, 3000]]
+
+class _Callback:
+    def __init__(self, pi, gpio, edge, func) -> None:
+        self._pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        self._pi._remove_callback(self)
+
+
+class _SimulatedFan:
+    def __init__(self, name, rpm_pin, pwm_pin, curve, pulses_per_rev) -> None:
+        self.name = name
+        self.rpm_pin = rpm_pin
+        self.pwm_pin = pwm_pin
+        self.curve = sorted(curve)
+        self.pulses_per_rev = pulses_per_rev
+
+    def rpm(self, duty_cycle):
+        curve = self.curve
+        if duty_cycle <= curve[0][0]:
+            return curve[0][1]
+        for (x0, y0), (x1, y1) in zip(curve, curve[1:]):
+            if duty_cycle <= x1:
+                return y0 + (y1 - y0) * (duty_cycle - x0) / (x1 - x0)
+        return curve[-1][1]
+
+
+class SimulatedPi:
+    """
+    Implements the subset of the pigpio.pi interface used by pyBMC. Edges and
+    watchdogs are generated by a single scheduler thread, which plays the
+    role of pigpio's callback thread.
+    """
+
+    def __init__(self, hwconfig, settings=None) -> None:
+        settings = settings or {}
+        self.connected = True
+
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._events = []
+        self._sequence = 0
+        self._running = True
+
+        self._levels = 0
+        self._modes = {}
+        self._pwm = {}
+        self._pwm_range = {}
+        self._callbacks = []
+        self._watchdogs = {}
+        self._watchdog_generation = 0
+        # Bumped with every write to the PSU switch, so power ok only follows the latest one
+        self._switch_generation = 0
+        self._scripts = {}
+        self._random = random.Random(settings.get("seed"))
+
+        fan_settings = hwconfig["fans"]["settings"]
+        sim_fans = settings.get("fans", {})
+        default_curve = sim_fans.get("curve", DEFAULT_FAN_CURVE)
+        self._fans_follow_psu = sim_fans.get("follow-psu", True)
+        self._fans = []
+        for fan_data in hwconfig["fans"]["case-fans"]:
+            curve = sim_fans.get("curves", {}).get(fan_data["name"], default_curve)
+            self._fans.append(_SimulatedFan(fan_data["name"], fan_data["rpm-pin"],
+                fan_data["pwm-pin"], curve, fan_settings.get("pulses-per-revolution", 1)))
+
+        # The DHT22 data line idles high
+        self._dht_pin = hwconfig["temp-sensors"][0]["pin"]
+        self._levels |= (1 << self._dht_pin)
+        sim_dht = settings.get("dht22", {})
+        self._temperature = sim_dht.get("temperature", 24.0)
+        self._humidity = sim_dht.get("humidity", 45.0)
+        self._dht_error_rates = sim_dht.get("error-rates", {})
+        self._dht_errors = []
+
+        psu = hwconfig["psu"]
+        self._psu_switch_pin = psu["power-switch-pin"]
+        self._psu_ok_pin = psu["power-ok-pin"]
+        sim_psu = settings.get("psu", {})
+        self._power_on_delay = sim_psu.get("power-on-delay", 0.3)
+        self._power_off_delay = sim_psu.get("power-off-delay", 0.05)
+        if sim_psu.get("initially-on", False):
+            self._levels |= (1 << self._psu_ok_pin)
+
+        now = time.monotonic()
+        for fan in self._fans:
+            self._schedule(now, self._tach_edge, fan)
+
+        self._thread = threading.Thread(target=self._run, name="simulated-pigpio", daemon=True)
+        self._thread.start()
+        logger.log("Simulated pigpio started")
+
+    #
+    # pigpio.pi interface
+    #
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        self._thread.join()
+
+    def get_current_tick(self):
+        return self._tick(time.monotonic())
+
+    def set_mode(self, gpio, mode):
+        with self._lock:
+            previous = self._modes.get(gpio, pigpio.INPUT)
+            self._modes[gpio] = mode
+            if gpio == self._dht_pin and previous == pigpio.OUTPUT and mode == pigpio.INPUT:
+                # End of the start pulse: the line is pulled back up, then the sensor answers
+                now = time.monotonic()
+                self._set_level(gpio, 1, now)
+                self._dht22_respond(now)
+
+    def get_mode(self, gpio):
+        return self._modes.get(gpio, pigpio.INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def set_glitch_filter(self, gpio, steady):
+        pass
+
+    def read(self, gpio):
+        return (self._levels >> gpio) & 1
+
+    def read_bank_1(self):
+        return self._levels
+
+    def write(self, gpio, level):
+        now = time.monotonic()
+        with self._lock:
+            self._modes[gpio] = pigpio.OUTPUT
+            self._set_level(gpio, level, now)
+            if gpio == self._psu_switch_pin:
+                self._switch_generation += 1
+                delay = self._power_on_delay if level else self._power_off_delay
+                self._schedule(now + delay, self._follow_switch, 1 if level else 0,
+                    self._switch_generation)
+
+    def set_PWM_frequency(self, user_gpio, frequency):
+        return frequency
+
+    def set_PWM_range(self, user_gpio, range_):
+        self._pwm_range[user_gpio] = range_
+
+    def set_PWM_dutycycle(self, user_gpio, dutycycle):
+        self._pwm[user_gpio] = dutycycle
+
+    def set_watchdog(self, user_gpio, wdog_timeout):
+        now = time.monotonic()
+        with self._lock:
+            if wdog_timeout:
+                # The generation retires the checks scheduled for a previous setting
+                self._watchdog_generation += 1
+                timeout = wdog_timeout / 1000
+                self._watchdogs[user_gpio] = [timeout, now + timeout, self._watchdog_generation]
+                self._schedule(now + timeout, self._check_watchdog, user_gpio, self._watchdog_generation)
+            else:
+                self._watchdogs.pop(user_gpio, None)
+
+    def callback(self, user_gpio, edge=pigpio.RISING_EDGE, func=None):
+        cb = _Callback(self, user_gpio, edge, func)
+        with self._lock:
+            self._callbacks.append(cb)
+        return cb
+
+    def store_script(self, script):
+        if isinstance(script, bytes):
+            script = script.decode()
+        with self._lock:
+            script_id = max(self._scripts, default=-1) + 1
+            self._scripts[script_id] = script.split()
+        return script_id
+
+    def run_script(self, script_id, params=None):
+        # Only the few commands pyBMC uses: w (write), m (mode) and mils (delay)
+        tokens = self._scripts[script_id]
+        when = time.monotonic()
+        with self._lock:
+            i = 0
+            while i < len(tokens):
+                cmd = tokens[i].lower()
+                if cmd == "w":
+                    self._schedule(when, self.write, int(tokens[i + 1]), int(tokens[i + 2]))
+                    i += 3
+                elif cmd == "m":
+                    mode = pigpio.INPUT if tokens[i + 2].lower() == "r" else pigpio.OUTPUT
+                    self._schedule(when, self.set_mode, int(tokens[i + 1]), mode)
+                    i += 3
+                elif cmd == "mils":
+                    when += int(tokens[i + 1]) / 1000
+                    i += 2
+                else:
+                    raise pigpio.error(f"unsupported script command '{cmd}'")
+        return 0
+
+    def delete_script(self, script_id):
+        with self._lock:
+            self._scripts.pop(script_id, None)
+
+    def notify_open(self):
+        raise pigpio.error("notifications are not supported by the simulator")
+
+    #
+    # Simulation controls
+    #
+
+    def inject_dht22_error(self, kind):
+        """Make the next DHT22 reading fail: "checksum", "short" or "missing"."""
+        with self._lock:
+            self._dht_errors.append(kind)
+
+    def set_environment(self, temperature=None, humidity=None):
+        with self._lock:
+            if temperature is not None:
+                self._temperature = temperature
+            if humidity is not None:
+                self._humidity = humidity
+
+    def set_power_ok(self, level):
+        """Drive power ok directly, as if the PSU was switched externally (or browned out)."""
+        with self._lock:
+            self._set_level(self._psu_ok_pin, level, time.monotonic())
+
+    #
+    # Internals
+    #
+
+    def _tick(self, now):
+        # Like pigpio, microseconds since boot, wrapping every ~72 minutes
+        return int(now * 1000000) & 0xffffffff
+
+    def _schedule(self, when, func, *args):
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._events, (when, self._sequence, func, args))
+            self._wakeup.notify()
+
+    def _remove_callback(self, cb):
+        with self._lock:
+            if cb in self._callbacks:
+                self._callbacks.remove(cb)
+
+    def _run(self):
+        with self._lock:
+            while self._running:
+                now = time.monotonic()
+                if self._events and self._events[0][0] <= now:
+                    _, _, func, args = heapq.heappop(self._events)
+                    func(*args)
+                elif self._events:
+                    self._wakeup.wait(self._events[0][0] - now)
+                else:
+                    self._wakeup.wait()
+
+    def _set_level(self, gpio, level, when):
+        mask = 1 << gpio
+        if bool(self._levels & mask) == bool(level):
+            return
+
+        self._levels = (self._levels | mask) if level else (self._levels & ~mask)
+        self._dispatch(gpio, 1 if level else 0, self._tick(when))
+        if gpio in self._watchdogs:
+            self._watchdogs[gpio][1] = when + self._watchdogs[gpio][0]
+
+    def _dispatch(self, gpio, level, tick):
+        for cb in list(self._callbacks):
+            if cb.gpio != gpio:
+                continue
+            if (level == pigpio.TIMEOUT or cb.edge == pigpio.EITHER_EDGE or
+                    (cb.edge == pigpio.RISING_EDGE and level == 1) or
+                    (cb.edge == pigpio.FALLING_EDGE and level == 0)):
+                cb.func(gpio, level, tick)
+
+    def _follow_switch(self, level, generation):
+        # The switch was flipped again before power ok caught up with this write
+        if generation != self._switch_generation:
+            return
+        self._set_level(self._psu_ok_pin, level, time.monotonic())
+
+    def _check_watchdog(self, gpio, generation):
+        watchdog = self._watchdogs.get(gpio)
+        if watchdog is None or watchdog[2] != generation:
+            return
+
+        now = time.monotonic()
+        timeout, deadline, _ = watchdog
+        if now >= deadline:
+            self._dispatch(gpio, pigpio.TIMEOUT, self._tick(now))
+            deadline = now + timeout
+            watchdog[1] = deadline
+        self._schedule(deadline, self._check_watchdog, gpio, generation)
+
+    def _tach_edge(self, fan):
+        now = time.monotonic()
+        duty_cycle = self._pwm.get(fan.pwm_pin, 0) * 100 / self._pwm_range.get(fan.pwm_pin, 255)
+        powered = not self._fans_follow_psu or self.read(self._psu_ok_pin)
+        rpm = fan.rpm(duty_cycle) if powered else 0
+        if rpm <= 0:
+            # Stopped; check again in a little while
+            self._schedule(now + 0.1, self._tach_edge, fan)
+            return
+
+        # Toggle the tach line; a little jitter keeps the estimators honest
+        self._set_level(fan.rpm_pin, not self.read(fan.rpm_pin), now)
+        half_period = 30.0 / (rpm * fan.pulses_per_rev)
+        self._schedule(now + half_period * self._random.uniform(0.98, 1.02), self._tach_edge, fan)
+
+    def _dht22_respond(self, start):
+        error = self._dht_errors.pop(0) if self._dht_errors else None
+        if error is None:
+            for kind, rate in self._dht_error_rates.items():
+                if self._random.random() < rate:
+                    error = kind
+                    break
+        if error == "missing":
+            # Never answers; the driver's watchdog will notice
+            return
+
+        self._temperature += self._random.uniform(-0.05, 0.05)
+        self._humidity = min(max(self._humidity + self._random.uniform(-0.1, 0.1), 0.0), 100.0)
+        humidity = int(round(self._humidity * 10))
+        temperature = int(round(abs(self._temperature) * 10))
+        if self._temperature < 0:
+            temperature |= 0x8000
+        data = [humidity >> 8, humidity & 0xff, temperature >> 8, temperature & 0xff]
+        checksum = sum(data) & 0xff
+        if error == "checksum":
+            checksum ^= 0x01
+        data.append(checksum)
+
+        bits = []
+        for byte in data:
+            for i in range(7, -1, -1):
+                bits.append((byte >> i) & 1)
+        if error == "short":
+            bits = bits[:20]
+
+        # Response: 80us low, 80us high, then per bit 50us low followed by a
+        # 26us (0) or 70us (1) high. The whole frame is delivered as a burst
+        # with the ticks the real sensor would have produced.
+        tick = self._tick(start)
+        edges = [(0, 20), (1, 80), (0, 80)]
+        for bit in bits:
+            edges.append((1, 50))
+            edges.append((0, 70 if bit else 26))
+        edges.append((1, 50))
+
+        mask = 1 << self._dht_pin
+        for level, delay in edges:
+            tick = (tick + delay) & 0xffffffff
+            self._levels = (self._levels | mask) if level else (self._levels & ~mask)
+            self._dispatch(self._dht_pin, level, tick)
+        if self._dht_pin in self._watchdogs:
+            self._watchdogs[self._dht_pin][1] = time.monotonic() + self._watchdogs[self._dht_pin][0]
@@ -105,6 +105,24 @@ import WebRequest from "./webrequest.js";
 
         webSocket.addEventListener("message", function (event) {
             const data = JSON.parse(event.data);
+            if (data.topic) {
+                // Pushed by the server for a subscription
+                switch (data.topic) {
+                    case "systemState":
+                        onSystemStateFrame(data);
+                        break;
+
+                    case "bmcStats":
+                        updateBmcStats(data.data);
+                        break;
+
+                    default:
+                        console.log(`Unrecognized topic '${data.topic}'`);
+                        break;
+                }
+                return;
+            }
+
             switch (data.request) {
                 case "getBmcInfo":
                     updateBmcInfo(data.response);
@@ -121,6 +139,9 @@ import WebRequest from "./webrequest.js";
                 case "setPsuPowerState":
                 case "setFanDutyCycle":
                 case "setFansDutyCycle":
+                case "subscribe":
+                case "unsubscribe":
+                case "resync":
                     break;
 
                 default:
@@ -383,24 +404,79 @@ import WebRequest from "./webrequest.js";
         }
     });
 
+    async function subscribe(topic, intervalMs, mode = "full") {
+        await webSocket.send(JSON.stringify({
+            command: "subscribe",
+            args: [ topic, intervalMs, mode ]
+        }));
+    }
+
+    async function resync(topic) {
+        await webSocket.send(JSON.stringify({
+            command: "resync",
+            args: [ topic ]
+        }));
+    }
+
+    // System state is subscribed to in delta mode: a full state comes first,
+    // then only what changed. Frames are numbered, so a gap means we missed one.
+    let systemState = null;
+    let systemStateSeq = 0;
+    let systemStateResyncing = false;
+    function onSystemStateFrame(frame) {
+        if (!frame.delta) {
+            systemState = frame.data;
+            systemStateResyncing = false;
+        } else if (systemState !== null && frame.seq === systemStateSeq + 1) {
+            applyDelta(systemState, frame.data);
+        } else {
+            // Wait for the full state before applying anything else
+            systemState = null;
+            if (!systemStateResyncing) {
+                systemStateResyncing = true;
+                resync("systemState");
+            }
+            return;
+        }
+        systemStateSeq = frame.seq;
+        updateSystemState(systemState);
+    }
+
+    function applyDelta(target, changes) {
+        for (const key in changes) {
+            const value = changes[key];
+            if (value !== null && typeof value === "object" && !Array.isArray(value) &&
+                target[key] !== null && typeof target[key] === "object") {
+                // Changes to lists are keyed by index, which works the same way
+                applyDelta(target[key], value);
+            } else {
+                target[key] = value;
+            }
+        }
+    }
+
+    async function unsubscribe(topic) {
+        await webSocket.send(JSON.stringify({
+            command: "unsubscribe",
+            args: [ topic ]
+        }));
+    }
+
+    // Updates are pushed by the server once subscribed, so there's no polling
     const autoRefresh = document.getElementById("auto-refresh-switch");
-    let bmcIntervalToken = null;
-    let fanIntervalToken = null;
     function startAutoRefresh() {
         setTimeout(() => {
             requestBmcInfo();
-            requestBmcStats();
-            requestSystemState();
-            bmcIntervalToken = setInterval(requestBmcStats, 1000);
-            fanIntervalToken = setInterval(requestSystemState, 250);
+            subscribe("bmcStats", 1000);
+            subscribe("systemState", 250, "delta");
         }, 600);
     }
 
     function stopAutoRefresh() {
-        clearInterval(bmcIntervalToken);
-        bmcIntervalToken = null;
-        clearInterval(fanIntervalToken);
-        fanIntervalToken = null;
+        if (webSocket.readyState === WebSocket.OPEN) {
+            unsubscribe("bmcStats");
+            unsubscribe("systemState");
+        }
     }
 
     autoRefresh.addEventListener("change", (event) => {
@@ -0,0 +1,337 @@
+#
+# RPM estimation from fan tachometer pulses
+#
+
+import math
+import os
+import struct
+import threading
+from array import array
+import pigpio
+from . import logger
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_WINDOW = 32
+DEFAULT_MAX_RPM = 5000
+
+class IntervalRing:
+    """
+    Fixed-size ring buffer of the most recent tach intervals, in microseconds.
+    Storage is allocated once, so recording an edge never allocates.
+    """
+
+    def __init__(self, size=DEFAULT_WINDOW) -> None:
+        self._data = array("I", [0]) * size
+        self._size = size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, interval):
+        self._data[self._next] = interval
+        self._next = (self._next + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def extend(self, intervals):
+        """Append a batch of intervals held in an array("I")."""
+        intervals = intervals[-self._size:]
+        count = len(intervals)
+        first = min(count, self._size - self._next)
+        self._data[self._next:self._next + first] = intervals[:first]
+        self._data[:count - first] = intervals[first:]
+        self._next = (self._next + count) % self._size
+        self._count = min(self._count + count, self._size)
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def newest(self, index):
+        """Return the interval recorded `index` edges ago (0 is the latest)."""
+        return self._data[(self._next - 1 - index) % self._size]
+
+    def values(self):
+        return [self.newest(i) for i in range(self._count)]
+
+
+class Estimator:
+    """Turns the recorded intervals into a single period (in microseconds)."""
+
+    def ring_size(self, size):
+        """Return how many intervals the ring should keep, given the configured size."""
+        return size
+
+    def update(self, interval):
+        pass
+
+    def update_many(self, intervals):
+        for interval in intervals:
+            self.update(interval)
+
+    def reset(self):
+        pass
+
+    def period(self, ring, age):
+        """`age` is how long ago (in microseconds) the latest edge came in."""
+        raise NotImplementedError
+
+
+class EwmaEstimator(Estimator):
+    def __init__(self, weighting=0.0) -> None:
+        # Weighting is a number between 0 and 1 and indicates how much the old reading affects the
+        # new reading. It defaults to 0 which means the old reading has no effect. This may be used
+        # to smooth the data.
+        if weighting < 0.0:
+            weighting = 0.0
+        elif weighting > 0.99:
+            weighting = 0.99
+
+        self._old_value_weight = weighting
+        self._new_value_weight = 1.0 - weighting
+        self._period = None
+
+    def update(self, interval):
+        if self._period is not None:
+            self._period = (self._period * self._old_value_weight) + (interval * self._new_value_weight)
+        else:
+            self._period = interval
+
+    def update_many(self, intervals):
+        if numpy is None or len(intervals) < 2:
+            return super().update_many(intervals)
+
+        if self._period is None:
+            self._period = intervals[0]
+            intervals = intervals[1:]
+
+        # Closed form of applying update() to every interval in turn
+        count = len(intervals)
+        weights = self._old_value_weight ** numpy.arange(count - 1, -1, -1)
+        values = numpy.frombuffer(intervals, dtype=numpy.uint32)
+        self._period = (self._period * self._old_value_weight ** count +
+            self._new_value_weight * float(numpy.dot(weights, values)))
+
+    def reset(self):
+        self._period = None
+
+    def period(self, ring, age):
+        return self._period
+
+
+class MedianEstimator(Estimator):
+    def period(self, ring, age):
+        count = len(ring)
+        if count == 0:
+            return None
+
+        values = sorted(ring.values())
+        middle = count // 2
+        if count % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2
+
+
+class TrimmedMeanEstimator(Estimator):
+    def __init__(self, trim=0.25) -> None:
+        # Fraction of the samples dropped from each end before averaging
+        self._trim = min(max(trim, 0.0), 0.49)
+
+    def period(self, ring, age):
+        count = len(ring)
+        if count == 0:
+            return None
+
+        values = sorted(ring.values())
+        cut = int(count * self._trim)
+        values = values[cut:count - cut]
+        return sum(values) / len(values)
+
+
+class EdgeCountEstimator(Estimator):
+    def __init__(self, window_ms=1000, max_edge_rate=None) -> None:
+        self._window = window_ms * 1000
+        # Edges per second at the fan's top speed, so the ring can span the window
+        self._max_edge_rate = max_edge_rate
+
+    def ring_size(self, size):
+        if self._max_edge_rate is None:
+            return size
+        return max(size, math.ceil(self._window / 1000000 * self._max_edge_rate))
+
+    def period(self, ring, age):
+        if len(ring) == 0 or age > self._window:
+            return None
+
+        # Count the edges that fall inside the window, walking back from the latest one
+        elapsed = age
+        edges = 1
+        for i in range(len(ring)):
+            elapsed += ring.newest(i)
+            if elapsed > self._window:
+                return self._window / edges
+            edges += 1
+
+        # Not a full window's worth of edges yet (the fan just started)
+        return elapsed / edges
+
+
+def create_estimator(settings):
+    name = settings.get("estimator", "ewma")
+    if name == "ewma":
+        return EwmaEstimator(settings.get("weighting", 0.0))
+    elif name == "median":
+        return MedianEstimator()
+    elif name == "trimmed-mean":
+        return TrimmedMeanEstimator(settings.get("trim", 0.25))
+    elif name == "edge-count":
+        max_edge_rate = settings.get("max-rpm", DEFAULT_MAX_RPM) * settings.get("pulses-per-revolution", 1) / 60
+        return EdgeCountEstimator(settings.get("window-ms", 1000), max_edge_rate)
+
+    raise RuntimeError(f"Unknown RPM estimator '{name}'")
+
+
+def tick_intervals(last_tick, ticks):
+    """
+    Return the intervals between consecutive ticks (starting from last_tick)
+    as an array("I"), taking care of the 32-bit tick wrap around.
+    """
+    intervals = array("I")
+    if numpy is not None and isinstance(ticks, numpy.ndarray):
+        # uint32 arithmetic wraps exactly like pigpio.tickDiff()
+        diffs = numpy.diff(ticks, prepend=numpy.uint32(last_tick))
+        intervals.frombytes(diffs.astype(numpy.uint32).tobytes())
+    else:
+        for tick in ticks:
+            intervals.append(pigpio.tickDiff(last_tick, tick))
+            last_tick = tick
+    return intervals
+
+
+REPORT_FORMAT = "HHII"
+REPORT_SIZE = struct.calcsize(REPORT_FORMAT)
+NON_LEVEL_FLAGS = pigpio.NTFY_FLAGS_WDOG | pigpio.NTFY_FLAGS_ALIVE | pigpio.NTFY_FLAGS_EVENT
+
+if numpy is not None:
+    REPORT_DTYPE = numpy.dtype([
+        ("seqno", "<u2"),
+        ("flags", "<u2"),
+        ("tick", "<u4"),
+        ("level", "<u4"),
+    ])
+
+class NotifyCapture:
+    """
+    Captures the tach edges of several RpmPins through a single pigpio
+    notification pipe. Reports are read in large chunks on one thread and
+    decoded in batches, instead of pigpio calling into Python for every edge.
+
+    Notification pipes are only available when pigpiod runs on this machine.
+    """
+
+    CHUNK_SIZE = REPORT_SIZE * 1024
+
+    def __init__(self, pi, rpm_pins) -> None:
+        self._pi = pi
+        self._pins = rpm_pins
+
+        self._handle = pi.notify_open()
+        try:
+            self._fd = os.open(f"/dev/pigpio{self._handle}", os.O_RDONLY)
+        except OSError:
+            pi.notify_close(self._handle)
+            raise
+
+        bits = 0
+        for gpio in rpm_pins:
+            bits |= 1 << gpio
+        self._last_level = pi.read_bank_1()
+
+        self._thread = threading.Thread(target=self._run, name="tach-capture", daemon=True)
+        self._thread.start()
+        pi.notify_begin(self._handle, bits)
+
+    def stop(self):
+        # Closing the handle closes the pipe, which ends the reader thread
+        self._pi.notify_close(self._handle)
+        self._thread.join()
+        os.close(self._fd)
+
+    def _run(self):
+        pending = b""
+        while True:
+            try:
+                data = os.read(self._fd, self.CHUNK_SIZE)
+            except OSError as e:
+                logger.log(f"Tach capture stopped: {e!r}")
+                break
+            if not data:
+                break
+
+            data = pending + data
+            usable = len(data) - len(data) % REPORT_SIZE
+            pending = data[usable:]
+            if numpy is not None:
+                self._decode_batch(data[:usable])
+            else:
+                self._decode(data[:usable])
+
+    def _decode_batch(self, data):
+        reports = numpy.frombuffer(data, dtype=REPORT_DTYPE)
+        flags = reports["flags"]
+        ticks = reports["tick"]
+
+        level_index = numpy.flatnonzero((flags & NON_LEVEL_FLAGS) == 0)
+        if len(level_index) > 0:
+            levels = reports["level"][level_index]
+            previous = numpy.empty_like(levels)
+            previous[0] = self._last_level
+            previous[1:] = levels[:-1]
+            self._last_level = int(levels[-1])
+            # Bits that went from 1 to 0 since the previous report
+            fallen = previous & ~levels
+        else:
+            fallen = numpy.zeros(0, dtype=numpy.uint32)
+
+        watchdog_index = numpy.flatnonzero(flags & pigpio.NTFY_FLAGS_WDOG)
+        watchdog_gpios = flags[watchdog_index] & pigpio.NTFY_FLAGS_GPIO
+
+        for gpio, rpm_pin in self._pins.items():
+            edges = ((fallen >> gpio) & 1).astype(bool)
+            edge_index = level_index[edges]
+            edge_ticks = ticks[edge_index]
+
+            # Watchdogs are rare, so interleave them with the edge batches in
+            # order; the stall check depends on what came before them.
+            start = 0
+            for index in watchdog_index[watchdog_gpios == gpio]:
+                split = int(numpy.searchsorted(edge_index, index))
+                rpm_pin.add_edges(edge_ticks[start:split])
+                rpm_pin.on_rpm_pin_falling_edge(gpio, pigpio.TIMEOUT, int(ticks[index]))
+                start = split
+            rpm_pin.add_edges(edge_ticks[start:])
+
+    def _decode(self, data):
+        edges = { gpio: [] for gpio in self._pins }
+        for _, flags, tick, level in struct.iter_unpack(REPORT_FORMAT, data):
+            if flags & pigpio.NTFY_FLAGS_WDOG:
+                gpio = flags & pigpio.NTFY_FLAGS_GPIO
+                if gpio in self._pins:
+                    self._pins[gpio].add_edges(edges[gpio])
+                    self._pins[gpio].on_rpm_pin_falling_edge(gpio, pigpio.TIMEOUT, tick)
+                    edges[gpio] = []
+            elif not flags & NON_LEVEL_FLAGS:
+                fallen = self._last_level & ~level
+                self._last_level = level
+                for gpio in self._pins:
+                    if fallen & (1 << gpio):
+                        edges[gpio].append(tick)
+
+        for gpio, rpm_pin in self._pins.items():
+            rpm_pin.add_edges(edges[gpio])